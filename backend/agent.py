@@ -1,3 +1,4 @@
+import os
 from dotenv import load_dotenv
 from livekit import agents
 from livekit.agents import AgentSession, Agent, RoomInputOptions
@@ -10,13 +11,18 @@ class Assistant(Agent):
     def __init__(self) -> None:
         super().__init__(instructions="You are a helpful voice AI assistant.")
 
+def prewarm(proc: agents.JobProcess):
+    # Load models once per worker process instead of once per room
+    proc.userdata["vad"] = silero.VAD.load()
+    proc.userdata["turn_detection"] = MultilingualModel()
+
 async def entrypoint(ctx: agents.JobContext):
     session = AgentSession(
         stt=deepgram.STT(model="nova-3", language="multi"),
         llm=google.LLM(model="gemini-2.5-flash"),
         tts=cartesia.TTS(model="sonic-2", voice="f786b574-daa5-4673-aa0c-cbe3e8534c02"),
-        vad=silero.VAD.load(),
-        turn_detection=MultilingualModel(),
+        vad=ctx.proc.userdata["vad"],
+        turn_detection=ctx.proc.userdata["turn_detection"],
     )
 
     await session.start(
@@ -34,4 +40,9 @@ async def entrypoint(ctx: agents.JobContext):
 
 if __name__ == "__main__":
 
-    agents.cli.run_app(agents.WorkerOptions(entrypoint_fnc=entrypoint))
\ No newline at end of file
+    # Named, so the worker only joins rooms whose join token dispatches it
+    agents.cli.run_app(agents.WorkerOptions(
+        entrypoint_fnc=entrypoint,
+        prewarm_fnc=prewarm,
+        agent_name=os.getenv("AGENT_NAME", "voice-assistant"),
+    ))
\ No newline at end of file
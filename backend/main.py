@@ -1,48 +1,58 @@
 import os
 import asyncio
 import asyncpg  # type: ignore
-import requests
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, TypedDict, NotRequired
+from uuid import UUID
 from fastapi import FastAPI, Query, Request, HTTPException, Depends
-from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.responses import PlainTextResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from livekit import api
 from dotenv import load_dotenv
 import jwt
+import orjson
 import logging
+import logging.handlers
+import queue
+import atexit
+import time
+from cachetools import LRUCache, TTLCache
 from contextlib import asynccontextmanager
-import subprocess
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
 # Payment imports
-import razorpay
+import httpx
+import base64
 import hmac
 import hashlib
-from datetime import datetime, timedelta
-from decimal import Decimal
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; records are queued and written by a listener thread, off the event loop
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, _log_stream_handler)
+logging.root.setLevel(logging.INFO)
+logging.root.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI(title="LiveKit Backend Service", version="1.0.0")
-
-# Security
-security = HTTPBearer()
-
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app = FastAPI(
+    title="LiveKit Backend Service",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    # Routes let unexpected errors propagate; HTTPExceptions keep their own status
+    logger.error("Unhandled error on %s %s", request.method, request.url.path, exc_info=exc)
+    return JSONResponse(status_code=500, content={"detail": "Internal server error"})
+
 # Database connection
 DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
@@ -62,49 +72,224 @@ SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
 if not SUPABASE_JWT_SECRET:
     raise ValueError("SUPABASE_JWT_SECRET is required")
 
+# Comma-separated browser origins allowed to call the API; native clients send no Origin
+CORS_ORIGINS = [o.strip() for o in os.getenv('CORS_ORIGINS', '*').split(',') if o.strip()]
+
 # Razorpay configuration
 RAZORPAY_KEY_ID = os.getenv('RAZORPAY_KEY_ID')
 RAZORPAY_KEY_SECRET = os.getenv('RAZORPAY_KEY_SECRET')
 if not RAZORPAY_KEY_ID or not RAZORPAY_KEY_SECRET:
     raise ValueError("RAZORPAY_KEY_ID and RAZORPAY_KEY_SECRET are required")
-razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
 
-# Database connection pool
-db_pool = None
+class AsyncRazorpay:
+    """Minimal non-blocking client for the Razorpay REST endpoints used here"""
+    def __init__(self, key_id: str, key_secret: str):
+        self._client = httpx.AsyncClient(
+            base_url="https://api.razorpay.com/v1/",
+            auth=(key_id, key_secret),
+            http2=True,
+            timeout=10,
+            limits=httpx.Limits(max_keepalive_connections=20),
+        )
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        response = await self._client.request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    async def fetch_customer(self, customer_id: str) -> dict:
+        return await self._request("GET", f"customers/{customer_id}")
+
+    async def create_customer(self, data: dict) -> dict:
+        return await self._request("POST", "customers", json=data)
+
+    async def create_plan(self, data: dict) -> dict:
+        return await self._request("POST", "plans", json=data)
+
+    async def all_plans(self, params: Optional[dict] = None) -> dict:
+        return await self._request("GET", "plans", params=params)
+
+    async def fetch_subscription(self, subscription_id: str) -> dict:
+        return await self._request("GET", f"subscriptions/{subscription_id}")
+
+    async def create_subscription(self, data: dict) -> dict:
+        return await self._request("POST", "subscriptions", json=data)
+
+    async def cancel_subscription(self, subscription_id: str) -> dict:
+        return await self._request("POST", f"subscriptions/{subscription_id}/cancel")
+
+    async def aclose(self):
+        await self._client.aclose()
+
+razorpay_client = AsyncRazorpay(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET)
+
+# Verified Supabase JWTs, keyed by token digest -> (user_id, payload)
+jwt_cache = TTLCache(maxsize=10000, ttl=60)
+
+# Users already known to exist -> (room_id, room_name); rooms are never reassigned
+user_room_cache = LRUCache(maxsize=100_000)
+# First-login upserts currently running per user; concurrent callers await the same future
+user_room_inflight: Dict[str, asyncio.Future] = {}
+
+# Subscription checks per user -> (is_subscribed, message). Every payments write calls
+# publish_payment_change, which evicts the entry in all workers via NOTIFY; the 30s TTL
+# bounds staleness only while a worker's payment_state_listener is reconnecting.
+payment_status_cache = TTLCache(maxsize=10000, ttl=30)
+# Checks currently running per user; concurrent callers await the same future
+payment_status_inflight: Dict[str, asyncio.Future] = {}
+PAYMENT_STATUS_ERRORS = frozenset({"Unable to verify subscription status", "Error checking subscription status"})
+
+# Serialized /api/payments/usage bodies per user; polled by the client, evicted in every
+# worker alongside the status above. Display only: session limits are checked in SQL.
+usage_cache = TTLCache(maxsize=10000, ttl=10)
+
+def forget_payment_state(user_id: Optional[str] = None):
+    """Drop cached payment status and usage for one user, or for everyone when user_id is None"""
+    if user_id is None:
+        payment_status_cache.clear()
+        usage_cache.clear()
+    else:
+        payment_status_cache.pop(user_id, None)
+        usage_cache.pop(user_id, None)
+
+# Payments writes are announced here so every worker drops its cached state;
+# payload is a user id, or empty for "everyone"
+PAYMENT_STATE_CHANNEL = "payment_state"
+PAYMENT_LISTENER_RETRY_SECONDS = 5
+
+async def publish_payment_change(conn, user_id: Optional[str] = None):
+    """Forget cached payment state here now, and in every worker once the write commits"""
+    forget_payment_state(user_id)
+    # Inside a transaction, NOTIFY is only delivered on commit
+    await conn.execute("SELECT pg_notify($1, $2)", PAYMENT_STATE_CHANNEL, user_id or "")
+
+def _on_payment_change(conn, pid, channel, payload: str):
+    forget_payment_state(payload or None)
+
+async def payment_state_listener():
+    """Keep this worker's payment caches in step with writes made by any worker."""
+    while True:
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            try:
+                await conn.add_listener(PAYMENT_STATE_CHANNEL, _on_payment_change)
+                # Anything cached while we were not listening may be stale
+                forget_payment_state()
+                while not conn.is_closed():
+                    await asyncio.sleep(PAYMENT_LISTENER_RETRY_SECONDS)
+            finally:
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Payment state listener error: %s", e)
+            await asyncio.sleep(PAYMENT_LISTENER_RETRY_SECONDS)
+
+# Serializes Razorpay plan creation per DB plan id
+razorpay_plan_locks: Dict[Any, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Razorpay plan listing as {(item name, amount in paise): plan_id}; rebuilt by razorpay_plan_sync
+razorpay_plan_index: Dict[tuple, str] = {}
+
+# Server workers; each one has its own event loop and its own pool
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', str(max(2, os.cpu_count() or 1))))
+
+# Database connection pool (per worker, so ~50 connections in total by default)
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', str(max(5, 50 // WEB_CONCURRENCY))))
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', str(min(10, DB_POOL_MAX_SIZE))))
+DB_POOL_MAX_QUERIES = int(os.getenv('DB_POOL_MAX_QUERIES', '50000'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '15'))
+# 0 keeps idle connections open, so a quiet spell never costs a fresh handshake + re-prepare
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '0'))
 
 # --- AGENT PROCESS MANAGEMENT ---
-active_agents: Dict[str, subprocess.Popen] = {}  # room_name -> process
+# A single long-lived `agent.py start` worker registers with LiveKit and keeps warm job
+# processes (models loaded once by prewarm); join tokens carry the dispatch for each room
+AGENT_NAME = os.getenv('AGENT_NAME', 'voice-assistant')
+# Only the worker holding this advisory lock runs the agent process
+AGENT_SUPERVISOR_LOCK_ID = 0x6167656E74  # "agent"
+AGENT_LEADER_POLL_SECONDS = 5
+AGENT_STOP_TIMEOUT_SECONDS = 10
+agent_process: Optional[asyncio.subprocess.Process] = None
 RAZORPAY_WEBHOOK_SECRET = os.getenv('RAZORPAY_WEBHOOK_SECRET')
 if not RAZORPAY_WEBHOOK_SECRET:
     raise ValueError("RAZORPAY_WEBHOOK_SECRET is required")
+RAZORPAY_WEBHOOK_SECRET_BYTES = RAZORPAY_WEBHOOK_SECRET.encode('utf-8')
 
 TRIAL_LIMIT_SECONDS=150
 
-def trigger_agent_connection(room_name: str):
-    """Start agent process for the room via subprocess and track it."""
-    try:
-        proc = subprocess.Popen([
-            "python", "agent.py", "connect", "--room", room_name
-        ])
-        active_agents[room_name] = proc
-        logger.info(f"Started agent for room {room_name}, PID {proc.pid}")
-    except Exception as e:
-        logger.error(f"Failed to start agent for room {room_name}: {e}")
-
-def stop_agent(room_name: str):
-    """Terminate agent process for the room if running."""
-    proc = active_agents.pop(room_name, None)
-    if proc:
-        logger.info(f"Terminating agent for room {room_name}, PID {proc.pid}")
-        proc.terminate()
+# Claims a Razorpay event id; no row back means another delivery already applied it
+CLAIM_WEBHOOK_EVENT_SQL = """
+    INSERT INTO webhook_events (event_id) VALUES ($1)
+    ON CONFLICT (event_id) DO NOTHING
+    RETURNING event_id
+"""
+# Razorpay stops retrying a delivery well within this window, so older claims can go
+WEBHOOK_EVENT_RETENTION_DAYS = 7
+WEBHOOK_EVENT_CLEANUP_SECONDS = 3600
+
+async def webhook_event_cleanup(pool):
+    """Periodically drop webhook event claims older than the retention window."""
+    while True:
         try:
-            proc.wait(timeout=5)
-            logger.info(f"Agent for room {room_name} terminated")
-        except Exception:
-            logger.warning(f"Agent for room {room_name} did not terminate in time, killing.")
-            proc.kill()
-    else:
-        logger.warning(f"No active agent found for room {room_name}")
+            await pool.execute(
+                "DELETE FROM webhook_events WHERE received_at < NOW() - make_interval(days => $1)",
+                WEBHOOK_EVENT_RETENTION_DAYS
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Webhook event cleanup failed: %s", e)
+        await asyncio.sleep(WEBHOOK_EVENT_CLEANUP_SECONDS)
+
+async def agent_supervisor():
+    """Elect one worker (via an advisory lock) to run the agent process, restarting it if it exits."""
+    while True:
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            try:
+                while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", AGENT_SUPERVISOR_LOCK_ID):
+                    await asyncio.sleep(AGENT_LEADER_POLL_SECONDS)
+                logger.info("Worker %s is now supervising agents", os.getpid())
+                # The lock lives as long as this connection
+                while not conn.is_closed():
+                    await start_agent_process()
+                    await asyncio.sleep(AGENT_LEADER_POLL_SECONDS)
+            finally:
+                # Whoever takes the lock next starts its own agent process
+                await stop_agent_process()
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Agent supervisor error: %s", e)
+            await asyncio.sleep(AGENT_LEADER_POLL_SECONDS)
+
+async def start_agent_process():
+    """Start the agent worker unless it is already running."""
+    global agent_process
+    if agent_process is not None and agent_process.returncode is None:
+        return
+    if agent_process is not None:
+        logger.warning("Agent worker exited with code %s, restarting", agent_process.returncode)
+    agent_process = await asyncio.create_subprocess_exec("python", "agent.py", "start")
+    logger.info("Started agent worker, PID %s", agent_process.pid)
+
+async def stop_agent_process():
+    """Terminate the agent worker if running, killing it if it does not drain in time."""
+    global agent_process
+    proc, agent_process = agent_process, None
+    if proc is None or proc.returncode is not None:
+        return
+    logger.info("Terminating agent worker, PID %s", proc.pid)
+    proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=AGENT_STOP_TIMEOUT_SECONDS)
+        logger.info("Agent worker terminated")
+    except asyncio.TimeoutError:
+        logger.warning("Agent worker did not terminate in time, killing.")
+        proc.kill()
+        await proc.wait()
 
 # --- Pydantic models ---
 class UserCreate(BaseModel):
@@ -115,49 +300,50 @@ class UserProfileUpdate(BaseModel):
     name: Optional[str] = None
     age: Optional[int] = None
 
-class UserProfileResponse(BaseModel):
+class UserProfileResponse(TypedDict):
     user_id: str
     name: str
-    age: Optional[int] = None
+    age: NotRequired[Optional[int]]
     onboarding: str
-    created_at: str
-    updated_at: str
+    created_at: datetime
+    updated_at: datetime
 
-class SessionResponse(BaseModel):
+# Hot-path response shapes: plain dicts serialized by orjson, typed for reference only
+class SessionResponse(TypedDict):
     session_id: str
     room_name: str
     room_id: str
     token: str
     livekit_url: str
 
-class RoomInfo(BaseModel):
+class RoomInfo(TypedDict):
     room_id: str
     room_name: str
     room_condition: str
     trial_seconds_used: int
 
 # Payment models
-class PlanResponse(BaseModel):
-    id: str
+class PlanResponse(TypedDict):
+    id: UUID
     name: str
     monthly_price: int
     monthly_limit: int
-    created_at: str
+    created_at: datetime
 
-class PaymentResponse(BaseModel):
-    id: str
-    user_id: str
-    plan_id: Optional[str]
+class PaymentResponse(TypedDict):
+    id: UUID
+    user_id: UUID
+    plan_id: Optional[UUID]
     razorpay_customer_id: str
     razorpay_subscription_id: str
     status: str
     session_limit: int
     session_used: int
-    start_at: str
-    end_at: Optional[str]
-    next_billing_at: Optional[str]
-    created_at: str
-    updated_at: str
+    start_at: datetime
+    end_at: Optional[datetime]
+    next_billing_at: Optional[datetime]
+    created_at: datetime
+    updated_at: datetime
 
 class CreateSubscriptionRequest(BaseModel):
     plan_id: str
@@ -169,183 +355,721 @@ class SubscriptionWebhookPayload(BaseModel):
     payload: dict
 
 # --- Database connection management ---
-async def get_db_pool():
-    global db_pool
-    if db_pool is None:
-        db_pool = await asyncpg.create_pool(DATABASE_URL)
-    return db_pool
-
-async def get_db():
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
+# Hot queries, prepared once per pooled connection
+# Insert the user if missing and return their room (NULL for a brand new user:
+# the create_room_for_new_user trigger only runs after this statement)
+UPSERT_USER_SQL = """
+    WITH ins_u AS (
+        INSERT INTO users (id, name, age, onboarding, created_at, updated_at)
+        VALUES ($1, $2, $3, 'Pending', NOW(), NOW())
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+    )
+    SELECT EXISTS (SELECT 1 FROM ins_u) AS created, r.id AS room_id, r.room_name
+    FROM (VALUES (1)) AS one
+    LEFT JOIN room r ON r.user_id = $1
+"""
+# Create or overwrite the user's profile from their token claims in one statement
+SYNC_USER_PROFILE_SQL = """
+    INSERT INTO users (id, name, age, onboarding, created_at, updated_at)
+    VALUES ($1, $2, $3, 'Done', NOW(), NOW())
+    ON CONFLICT (id) DO UPDATE
+    SET name = EXCLUDED.name, age = EXCLUDED.age, onboarding = 'Done', updated_at = NOW()
+    RETURNING id::text AS user_id, name, age, onboarding, created_at, updated_at
+"""
+UPSERT_ROOM_SQL = """
+    WITH ins_r AS (
+        INSERT INTO room (user_id, room_name, room_condition, created_at, updated_at)
+        VALUES ($1, $2, 'off', NOW(), NOW())
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING id, room_name
+    )
+    SELECT id, room_name FROM ins_r
+    UNION ALL
+    SELECT id, room_name FROM room WHERE user_id = $1
+    LIMIT 1
+"""
+SELECT_USER_ROOM_INFO_SQL = """
+    SELECT r.id, r.room_name, r.room_condition, u.trial_seconds_used
+    FROM room r
+    JOIN users u ON r.user_id = u.id
+    WHERE r.user_id = $1
+"""
+# One page of unfinished sessions, newest first, as a ready-to-send JSON array;
+# ($2, $4) is the (started_at, id) keyset cursor of the previous page's last row, NULL
+# for the first page; id breaks started_at ties. started_at is rendered in UTC
+# explicitly, so the output does not depend on the session TimeZone setting.
+SELECT_ACTIVE_SESSIONS_SQL = """
+    SELECT COALESCE(json_agg(json_build_object(
+        'id', page.id,
+        'started_at', to_char(page.started_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"'),
+        'room_name', page.room_name,
+        'room_condition', page.room_condition
+    ) ORDER BY page.started_at DESC, page.id DESC), '[]')::text
+    FROM (
+        SELECT s.id, s.started_at, r.room_name, r.room_condition
+        FROM sessions s
+        JOIN room r ON s.room_id = r.id
+        WHERE s.user_id = $1 AND s.finished_at IS NULL
+          AND ($2::timestamptz IS NULL OR (s.started_at, s.id) < ($2, $4::uuid))
+        ORDER BY s.started_at DESC, s.id DESC
+        LIMIT $3
+    ) AS page
+"""
+START_SESSION_SQL = """
+    WITH r AS (
+        UPDATE room
+        SET room_condition = 'on', updated_at = NOW()
+        WHERE user_id = $1
+        RETURNING id, room_name
+    ), s AS (
+        INSERT INTO sessions (user_id, room_id, started_at)
+        SELECT $1, r.id, NOW() FROM r
+        RETURNING id
+    )
+    SELECT r.id AS room_id, r.room_name, s.id AS session_id
+    FROM r, s
+"""
+# Same as START_SESSION_SQL, but only opens the session while the user's trial
+# allowance ($2 seconds) is not used up; always returns trial_seconds_used
+START_TRIAL_SESSION_SQL = """
+    WITH u AS (
+        SELECT trial_seconds_used FROM users WHERE id = $1
+    ), r AS (
+        UPDATE room
+        SET room_condition = 'on', updated_at = NOW()
+        WHERE user_id = $1 AND (SELECT trial_seconds_used FROM u) < $2
+        RETURNING id, room_name
+    ), s AS (
+        INSERT INTO sessions (user_id, room_id, started_at)
+        SELECT $1, r.id, NOW() FROM r
+        RETURNING id
+    )
+    SELECT u.trial_seconds_used, r.id AS room_id, r.room_name, s.id AS session_id
+    FROM u
+    LEFT JOIN r ON TRUE
+    LEFT JOIN s ON TRUE
+"""
+# Same as START_SESSION_SQL for subscribers: also takes one session from the newest
+# live payment, and only opens the session if that payment still has one left
+START_PAID_SESSION_SQL = """
+    WITH p AS (
+        UPDATE payments
+        SET session_used = session_used + 1, updated_at = NOW()
+        WHERE id = (
+            SELECT id FROM payments
+            WHERE user_id = $1 AND status IN ('active', 'past_due') AND session_used < session_limit
+            ORDER BY created_at DESC
+            LIMIT 1
+        )
+        RETURNING id
+    ), r AS (
+        UPDATE room
+        SET room_condition = 'on', updated_at = NOW()
+        WHERE user_id = $1 AND EXISTS (SELECT 1 FROM p)
+        RETURNING id, room_name
+    ), s AS (
+        INSERT INTO sessions (user_id, room_id, started_at)
+        SELECT $1, r.id, NOW() FROM r
+        RETURNING id
+    )
+    SELECT p.id AS payment_id, r.id AS room_id, r.room_name, s.id AS session_id
+    FROM p
+    LEFT JOIN r ON TRUE
+    LEFT JOIN s ON TRUE
+"""
+# Finish the user's active session, turn the room off and, when $3 (trial session),
+# add its duration to trial_seconds_used; returns the duration, or no row if nothing ended
+END_SESSION_SQL = """
+    WITH ended AS (
+        UPDATE sessions
+        SET finished_at = NOW()
+        WHERE id = $1 AND user_id = $2 AND finished_at IS NULL
+        RETURNING FLOOR(EXTRACT(EPOCH FROM finished_at - started_at))::int AS duration_seconds
+    ), trial AS (
+        UPDATE users
+        SET trial_seconds_used = trial_seconds_used + ended.duration_seconds
+        FROM ended
+        WHERE users.id = $2 AND $3
+    ), r AS (
+        UPDATE room
+        SET room_condition = 'off', updated_at = NOW()
+        WHERE user_id = $2 AND EXISTS (SELECT 1 FROM ended)
+    )
+    SELECT duration_seconds FROM ended
+"""
+# Latest live payment for a user; served by idx_payments_user_live
+SELECT_LIVE_PAYMENT_SQL = """
+    SELECT session_limit, session_used, status, end_at, next_billing_at, razorpay_subscription_id
+    FROM payments
+    WHERE user_id = $1 AND status IN ('active', 'past_due', 'created')
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+# Latest active payment, shaped as PaymentResponse, for /api/payments/current
+SELECT_ACTIVE_PAYMENT_SQL = """
+    SELECT id, user_id, plan_id, razorpay_customer_id, razorpay_subscription_id,
+           status, session_limit, session_used, start_at, end_at, next_billing_at,
+           created_at, updated_at
+    FROM payments
+    WHERE user_id = $1 AND status = 'active'
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+# A user's full payment history, newest first, for /api/payments/history
+SELECT_PAYMENT_HISTORY_SQL = """
+    SELECT p.id, pl.name as plan_name, p.status, p.session_limit, p.session_used,
+           p.start_at, p.end_at, p.created_at
+    FROM payments p
+    LEFT JOIN plans pl ON p.plan_id = pl.id
+    WHERE p.user_id = $1
+    ORDER BY p.created_at DESC
+"""
+# Webhook status transitions, keyed by Razorpay subscription id ($1)
+UPDATE_SUBSCRIPTION_STATUS_SQL = """
+    UPDATE payments
+    SET status = $2, updated_at = NOW()
+    WHERE razorpay_subscription_id = $1
+    RETURNING id
+"""
+ACTIVATE_SUBSCRIPTION_SQL = """
+    UPDATE payments
+    SET status = 'active', start_at = $2, updated_at = NOW()
+    WHERE razorpay_subscription_id = $1
+    RETURNING id
+"""
+END_SUBSCRIPTION_SQL = """
+    UPDATE payments
+    SET status = 'cancelled', end_at = (NOW() AT TIME ZONE 'UTC'), updated_at = NOW()
+    WHERE razorpay_subscription_id = $1
+    RETURNING id
+"""
+# Read-only route queries run straight on the pool (asyncpg caches their statements)
+SELECT_PLANS_SQL = """
+    SELECT id, name, monthly_price, monthly_limit, created_at
+    FROM plans
+    ORDER BY monthly_price ASC
+"""
+SELECT_USAGE_SQL = """
+    SELECT session_limit, session_used, status, next_billing_at
+    FROM payments
+    WHERE user_id = $1 AND status = 'active'
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+HOT_STATEMENTS = (
+    UPSERT_USER_SQL,
+    SYNC_USER_PROFILE_SQL,
+    UPSERT_ROOM_SQL,
+    SELECT_USER_ROOM_INFO_SQL,
+    START_SESSION_SQL,
+    START_TRIAL_SESSION_SQL,
+    START_PAID_SESSION_SQL,
+    END_SESSION_SQL,
+    SELECT_LIVE_PAYMENT_SQL,
+    SELECT_PAYMENT_HISTORY_SQL,
+    UPDATE_SUBSCRIPTION_STATUS_SQL,
+    ACTIVATE_SUBSCRIPTION_SQL,
+    END_SUBSCRIPTION_SQL,
+)
+
+class PreparedConnection(asyncpg.Connection):
+    """Connection that keeps the hot statements prepared for its lifetime"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+async def _prepare_statements(conn):
+    for query in HOT_STATEMENTS:
+        conn.prepared[query] = await conn.prepare(query)
+
+async def update_subscription_status(conn, subscription_id: str, status: str) -> int:
+    """Set the status of a subscription's payment rows; returns rows updated"""
+    return len(await conn.prepared[UPDATE_SUBSCRIPTION_STATUS_SQL].fetch(subscription_id, status))
+
+async def activate_subscription(conn, subscription_id: str, start_at: datetime) -> int:
+    """Mark a subscription active from start_at; returns rows updated"""
+    return len(await conn.prepared[ACTIVATE_SUBSCRIPTION_SQL].fetch(subscription_id, start_at))
+
+async def end_subscription(conn, subscription_id: str) -> int:
+    """Mark a subscription cancelled as of now; returns rows updated"""
+    return len(await conn.prepared[END_SUBSCRIPTION_SQL].fetch(subscription_id))
+
+async def init_db_pool():
+    """Create the shared connection pool; called once from lifespan, which keeps it on app.state"""
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_queries=DB_POOL_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=1024,
+        max_cached_statement_lifetime=0,
+        connection_class=PreparedConnection,
+        init=_prepare_statements,
+        # Short OLTP queries only; JIT compilation would cost more than it saves
+        # application_name tags these sessions in pg_stat_activity
+        server_settings={"jit": "off", "application_name": "livekit-backend"},
+    )
+
+async def get_db(request: Request):
+    async with request.app.state.pool.acquire() as conn:
         yield conn
 
-async def get_current_user_with_metadata(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# One decoder with fixed options, reused for every Supabase token
+_SUPABASE_JWT_KEY = SUPABASE_JWT_SECRET.encode()
+_jwt_decoder = jwt.PyJWT(options={
+    "verify_signature": True,
+    "require": ["exp", "sub", "aud"] + (["iss"] if DATABASE_ISSUER else []),
+})
+_SUPABASE_JWT_DECODE_KWARGS = {
+    "algorithms": ["HS256"],
+    "audience": "authenticated",
+    "issuer": DATABASE_ISSUER,
+}
+
+async def get_current_user_with_metadata(token: str):
+    """Verify a Supabase access token and return (user_id, payload)"""
     try:
-        token = credentials.credentials
-        logger.info(f"Attempting to decode token: {token[:20]}...")
-        payload = jwt.decode(
-            token,
-            SUPABASE_JWT_SECRET,
-            algorithms=["HS256"],
-            audience="authenticated",
-            issuer=DATABASE_ISSUER
-        )
+        cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        cached = jwt_cache.get(cache_key)
+        if cached and cached[1].get("exp", 0) > time.time():
+            return cached
+        payload = _jwt_decoder.decode(token, _SUPABASE_JWT_KEY, **_SUPABASE_JWT_DECODE_KWARGS)
         user_id = payload.get("sub")
         if not user_id:
             logger.error("No 'sub' claim found in token")
             raise HTTPException(status_code=401, detail="Invalid token: no user ID")
-        logger.info(f"Successfully authenticated user: {user_id}")
+        logger.debug("Successfully authenticated user: %s", user_id)
+        jwt_cache[cache_key] = (user_id, payload)
         return user_id, payload
     except jwt.ExpiredSignatureError:
         logger.error("Token expired")
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError as e:
-        logger.error(f"Invalid token: {str(e)}")
+        logger.error("Invalid token: %s", e)
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
     except Exception as e:
-        logger.error(f"Unexpected error in authentication: {str(e)}")
+        logger.error("Unexpected error in authentication: %s", e)
         raise HTTPException(status_code=401, detail="Authentication failed")
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    user_id, _ = await get_current_user_with_metadata(credentials)
-    return user_id
+class AuthASGIMiddleware:
+    """Authenticate the bearer token once per request and stash the result in scope state"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in PUBLIC_PATHS:
+            await self.app(scope, receive, send)
+            return
+        token = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, credentials = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and credentials:
+                    token = credentials
+                break
+        try:
+            if not token:
+                raise HTTPException(status_code=401, detail="Not authenticated")
+            user_id, payload = await get_current_user_with_metadata(token)
+        except HTTPException as e:
+            response = ORJSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            await response(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+        state["user_id"] = user_id
+        state["token_payload"] = payload
+        await self.app(scope, receive, send)
+
+# Routes that do their own verification (webhooks) or need none
+PUBLIC_PATHS = frozenset({
+    "/health", "/healthz", "/ping", "/config", "/getToken",
+    "/livekit-webhook", "/api/payments/webhook", "/api/plans",
+    "/docs", "/redoc", "/openapi.json",
+})
+
+app.add_middleware(AuthASGIMiddleware)
+
+# Compress JSON bodies big enough to be worth it (payment history, plans)
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+# CORS middleware, wraps auth so 401s still carry CORS headers.
+# Auth uses bearer tokens, so credentials are only allowed for an explicit origin list.
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=CORS_ORIGINS != ["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+class StaticASGIMiddleware:
+    """Answer GETs on fixed-body probe routes before CORS, auth and routing run"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "GET":
+            response = STATIC_RESPONSES.get(scope["path"])
+            if response is not None:
+                await send(response[0])
+                await send(response[1])
+                return
+        await self.app(scope, receive, send)
+
+# Added last so it is outermost; health probes need no CORS headers
+app.add_middleware(StaticASGIMiddleware)
 
 # --- Database functions ---
 async def ensure_user_exists(conn, user_id: str, supabase_user: Optional[Dict] = None):
-    """Ensure user exists in database and has a room assigned"""
+    """Ensure user exists in database and has a room assigned, using the local cache"""
+    cached = user_room_cache.get(user_id)
+    if cached:
+        return cached
+    inflight = user_room_inflight.get(user_id)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    future = asyncio.get_running_loop().create_future()
+    user_room_inflight[user_id] = future
+    try:
+        result = await upsert_user_and_room(conn, user_id, supabase_user)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved when nobody else is waiting
+        raise
+    finally:
+        user_room_inflight.pop(user_id, None)
+
+async def upsert_user_and_room(conn, user_id: str, supabase_user: Optional[Dict] = None):
+    """Insert the user if missing, make sure they have a room, and cache (room_id, room_name)"""
     try:
-        existing_user = await conn.fetchrow("SELECT id FROM users WHERE id = $1", user_id)
-        if not existing_user:
-            name = 'Anonymous'
-            age = None
-            if supabase_user:
-                user_metadata = supabase_user.get('user_metadata', {})
-                name = user_metadata.get('name', 'Anonymous')
-                age = user_metadata.get('age')
-                if not user_metadata:
-                    raw_metadata = supabase_user.get('raw_user_meta_data', {})
-                    name = raw_metadata.get('name', 'Anonymous')
-                    age = raw_metadata.get('age')
-            await conn.execute("""
-                INSERT INTO users (id, name, age, onboarding, created_at, updated_at)
-                VALUES ($1, $2, $3, 'Pending', NOW(), NOW())
-            """, user_id, name, age)
-            logger.info(f"Created new user: {user_id} with name: {name}, age: {age}")
-
-        room = await conn.fetchrow("SELECT id, room_name FROM room WHERE user_id = $1", user_id)
-        if not room:
-            room_name = f"room_{user_id}"
-            room_id = await conn.fetchval("""
-                INSERT INTO room (user_id, room_name, room_condition, created_at, updated_at)
-                VALUES ($1, $2, 'off', NOW(), NOW())
-                RETURNING id
-            """, user_id, room_name)
-            logger.info(f"Created room for user {user_id}: {room_name}")
-            return str(room_id), room_name
-        return str(room['id']), room['room_name']
+        name = 'Anonymous'
+        age = None
+        if supabase_user:
+            user_metadata = supabase_user.get('user_metadata', {})
+            name = user_metadata.get('name', 'Anonymous')
+            age = user_metadata.get('age')
+            if not user_metadata:
+                raw_metadata = supabase_user.get('raw_user_meta_data', {})
+                name = raw_metadata.get('name', 'Anonymous')
+                age = raw_metadata.get('age')
+        row = await conn.prepared[UPSERT_USER_SQL].fetchrow(user_id, name, age)
+        if row['created']:
+            logger.info("Created new user: %s with name: %s, age: %s", user_id, name, age)
+        if row['room_id']:
+            user_room_cache[user_id] = str(row['room_id']), row['room_name']
+            return user_room_cache[user_id]
+
+        room = await conn.prepared[UPSERT_ROOM_SQL].fetchrow(user_id, f"room_{user_id}")
+        logger.info("Ensured room for user %s: %s", user_id, room['room_name'])
+        user_room_cache[user_id] = str(room['id']), room['room_name']
+        return user_room_cache[user_id]
     except Exception as e:
-        logger.error(f"Error ensuring user exists: {str(e)}")
+        logger.error("Error ensuring user exists: %s", e)
         raise HTTPException(status_code=500, detail="Database error")
 
-async def create_session(conn, user_id: str, room_id: str):
+async def create_session(conn, user_id: str):
+    """Turn the room on and open a session in one round-trip; returns (room_id, room_name, session_id)"""
     try:
-        async with conn.transaction():
-            session_id = await conn.fetchval("""
-                INSERT INTO sessions (user_id, room_id, started_at)
-                VALUES ($1, $2, NOW())
-                RETURNING id
-            """, user_id, room_id)
-            await conn.execute("""
-                UPDATE room
-                SET room_condition = 'on', updated_at = NOW()
-                WHERE id = $1
-            """, room_id)
-            logger.info(f"Created session {session_id} for user {user_id}")
-            return str(session_id)
+        row = await conn.prepared[START_SESSION_SQL].fetchrow(user_id)
+        if not row:
+            # No room yet (brand new user) - create it, then retry
+            await ensure_user_exists(conn, user_id)
+            row = await conn.prepared[START_SESSION_SQL].fetchrow(user_id)
+        if not row:
+            raise HTTPException(status_code=500, detail="Failed to create session")
+        logger.debug("Created session %s for user %s", row['session_id'], user_id)
+        return str(row['room_id']), row['room_name'], str(row['session_id'])
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error creating session: {str(e)}")
+        logger.error("Error creating session: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create session")
 
+async def create_paid_session(conn, user_id: str):
+    """Use one paid session and open it in one round-trip; returns (room_id, room_name, session_id)"""
+    # The limit itself is enforced by the statement against the live row, never by a cache
+    row = await conn.prepared[START_PAID_SESSION_SQL].fetchrow(user_id)
+    await publish_payment_change(conn, user_id)
+    if not row:
+        # The cached status was stale: no live payment with sessions left
+        raise HTTPException(status_code=403, detail="Session limit exceeded for current billing cycle")
+    logger.debug("Incremented paid session usage for user %s", user_id)
+    if row['session_id'] is None:
+        # No room yet - the session was already paid for, so only open it
+        return await create_session(conn, user_id)
+    logger.debug("Created session %s for user %s", row['session_id'], user_id)
+    return str(row['room_id']), row['room_name'], str(row['session_id'])
+
+async def create_trial_session(conn, user_id: str):
+    """Check the trial allowance and open a session in one round-trip; returns (room_id, room_name, session_id)"""
+    row = await conn.prepared[START_TRIAL_SESSION_SQL].fetchrow(user_id, TRIAL_LIMIT_SECONDS)
+    if not row or (row['session_id'] is None and row['trial_seconds_used'] < TRIAL_LIMIT_SECONDS):
+        # No user or room yet - create them, then retry
+        await ensure_user_exists(conn, user_id)
+        row = await conn.prepared[START_TRIAL_SESSION_SQL].fetchrow(user_id, TRIAL_LIMIT_SECONDS)
+
+    if not row:
+        raise HTTPException(status_code=404, detail="User not found.")
+
+    # Check if trial is exhausted
+    if row['trial_seconds_used'] >= TRIAL_LIMIT_SECONDS:
+        logger.warning("User %s has exhausted trial (%ss) and has no subscription.", user_id, row['trial_seconds_used'])
+        raise HTTPException(status_code=403, detail="Your free trial has ended. Please subscribe to continue.")
+
+    if row['session_id'] is None:
+        raise HTTPException(status_code=500, detail="Failed to create session")
+
+    logger.debug("User %s has %ss of trial remaining.", user_id, TRIAL_LIMIT_SECONDS - row['trial_seconds_used'])
+    return str(row['room_id']), row['room_name'], str(row['session_id'])
+
 async def end_session(conn, session_id: str, user_id: str):
     try:
-        async with conn.transaction():
-            # Find the active session for the user
-            session = await conn.fetchrow(
-                "SELECT id, started_at FROM sessions WHERE id = $1 AND user_id = $2 AND finished_at IS NULL",
-                session_id, user_id
-            )
-            if not session:
-                logger.warning(f"Attempted to end a non-existent or already ended session: {session_id} for user {user_id}")
-                return
-
-            # Mark session as finished
-            await conn.execute("""
-                UPDATE sessions 
-                SET finished_at = NOW()
-                WHERE id = $1
-            """, session_id)
-            
-            # Check if the user is on a paid plan. If not, update their trial usage.
-            is_subscribed, _ = await check_payment_status(user_id, conn)
-            
-            if not is_subscribed:
-                # This was a trial session, so we record the duration used.
-                duration = datetime.now(timezone.utc) - session['started_at']
-                duration_seconds = int(duration.total_seconds())
-
-                await conn.execute(
-                    "UPDATE users SET trial_seconds_used = trial_seconds_used + $1 WHERE id = $2",
-                    duration_seconds, user_id
-                )
-                logger.info(f"Recorded {duration_seconds}s of trial usage for user {user_id}")
-            else:
-                # This was a paid session, no need to update trial usage.
-                logger.info(f"User {user_id} is subscribed, not updating trial usage.")
-
-            # Set room condition to 'off'
-            await conn.execute("""
-                UPDATE room 
-                SET room_condition = 'off', updated_at = NOW()
-                WHERE user_id = $1
-            """, user_id)
-            
-            logger.info(f"Ended session {session_id} for user {user_id}")
+        # Only trial sessions count against the trial allowance
+        is_subscribed, _ = await check_payment_status(user_id, conn)
+        duration_seconds = await conn.prepared[END_SESSION_SQL].fetchval(session_id, user_id, not is_subscribed)
+        if duration_seconds is None:
+            logger.warning("Attempted to end a non-existent or already ended session: %s for user %s", session_id, user_id)
+            return
+        if is_subscribed:
+            logger.debug("User %s is subscribed, not updating trial usage.", user_id)
+        else:
+            logger.debug("Recorded %ss of trial usage for user %s", duration_seconds, user_id)
+        logger.debug("Ended session %s for user %s", session_id, user_id)
     except Exception as e:
-        logger.error(f"Error ending session: {str(e)}")
+        logger.error("Error ending session: %s", e)
         raise HTTPException(status_code=500, detail="Failed to end session")
 
+# --- LiveKit token utility ---
+# Equivalent to api.AccessToken(...).with_grants(VideoGrants(room_join, room, room_create))
+# .with_room_config(RoomConfiguration(agents=[RoomAgentDispatch(agent_name=AGENT_NAME)])).to_jwt(),
+# signed directly so the header and key are only built once. LiveKit dispatches the agent
+# worker when the participant joins, so starting a session needs no API round trip.
+LIVEKIT_TOKEN_TTL_SECONDS = 6 * 60 * 60
+_LIVEKIT_JWT_HEADER = base64.urlsafe_b64encode(
+    orjson.dumps({"alg": "HS256", "typ": "JWT"})
+).rstrip(b"=")
+# Keyed HMAC state; copied per token so the key pads are only hashed once
+_LIVEKIT_HMAC = hmac.new(LIVEKIT_API_SECRET.encode(), digestmod=hashlib.sha256)
+# Signed tokens per (identity, name, room); handed out again while >= 5h of their 6h remain
+LIVEKIT_TOKEN_REUSE_SECONDS = 60 * 60
+livekit_token_cache = TTLCache(maxsize=100_000, ttl=LIVEKIT_TOKEN_REUSE_SECONDS)
+
+def generate_access_token(identity: str, name: str, room: str) -> str:
+    """Return a LiveKit join token for the given identity and room, reusing a recent one"""
+    key = (identity, name, room)
+    token = livekit_token_cache.get(key)
+    if token is None:
+        token = livekit_token_cache[key] = mint_access_token(identity, name, room)
+    return token
+
+def mint_access_token(identity: str, name: str, room: str) -> str:
+    """Mint a LiveKit join token for the given identity and room"""
+    now = int(time.time())
+    claims = {
+        "iss": LIVEKIT_API_KEY,
+        "sub": identity,
+        "name": name,
+        "nbf": now,
+        "exp": now + LIVEKIT_TOKEN_TTL_SECONDS,
+        "video": {"roomJoin": True, "room": room, "roomCreate": True},
+        "roomConfig": {"agents": [{"agentName": AGENT_NAME}]},
+    }
+    signing_input = _LIVEKIT_JWT_HEADER + b"." + base64.urlsafe_b64encode(orjson.dumps(claims)).rstrip(b"=")
+    mac = _LIVEKIT_HMAC.copy()
+    mac.update(signing_input)
+    signature = mac.digest()
+    return (signing_input + b"." + base64.urlsafe_b64encode(signature).rstrip(b"=")).decode()
+
+def verify_livekit_webhook(body: bytes, auth_header: Optional[str]) -> bool:
+    """Verify a LiveKit webhook: the Authorization JWT must be ours and carry the body's sha256"""
+    if not auth_header:
+        return False
+    try:
+        claims = jwt.decode(
+            auth_header.removeprefix("Bearer "),
+            LIVEKIT_API_SECRET,
+            algorithms=["HS256"],
+            issuer=LIVEKIT_API_KEY,
+            leeway=10
+        )
+    except jwt.InvalidTokenError as e:
+        logger.error("Invalid LiveKit webhook token: %s", e)
+        return False
+    body_hash = base64.b64encode(hashlib.sha256(body).digest()).decode()
+    return hmac.compare_digest(body_hash, claims.get("sha256", ""))
+
 # --- Payment utility ---
-def verify_razorpay_signature(payload_body: bytes, signature: str, secret: str) -> bool:
+def verify_razorpay_signature(payload_body: bytes, signature: str, secret: bytes) -> bool:
     """Verify Razorpay webhook signature"""
     try:
-        expected_signature = hmac.new(
-            secret.encode('utf-8'),
-            payload_body,
-            hashlib.sha256
-        ).hexdigest()
-
         # Razorpay sends signature in format: "sha256=hash"
         # Extract just the hash part
         if signature.startswith('sha256='):
             signature = signature[7:]
-        
+
+        # A hex SHA-256 digest is always 64 chars; skip the HMAC for anything else
+        if len(signature) != 64:
+            return False
+
+        expected_signature = hmac.digest(secret, payload_body, 'sha256').hex()
         return hmac.compare_digest(expected_signature, signature)
     except Exception as e:
-        logger.error(f"Signature verification error: {e}")
+        logger.error("Signature verification error: %s", e)
         return False
 
+RAZORPAY_PLANS_PAGE_SIZE = 100
+RAZORPAY_PLAN_SYNC_SECONDS = 600
+
+async def refresh_razorpay_plan_index():
+    """Rebuild razorpay_plan_index from the full Razorpay plan listing"""
+    # Page through at the API maximum (100); the default page is only 10 plans
+    index = {}
+    skip = 0
+    while True:
+        plans = await razorpay_client.all_plans({"count": RAZORPAY_PLANS_PAGE_SIZE, "skip": skip})
+        for rp in plans['items']:
+            index.setdefault((rp['item']['name'], rp['item']['amount']), rp['id'])
+        if len(plans['items']) < RAZORPAY_PLANS_PAGE_SIZE:
+            break
+        skip += RAZORPAY_PLANS_PAGE_SIZE
+    razorpay_plan_index.clear()
+    razorpay_plan_index.update(index)
+
+async def razorpay_plan_sync(pool):
+    """Keep the plan index fresh and link DB plans to existing Razorpay plans, off the request path."""
+    while True:
+        try:
+            await refresh_razorpay_plan_index()
+            async with pool.acquire() as conn:
+                unlinked = await conn.fetch(
+                    "SELECT id, name, monthly_price FROM plans WHERE razorpay_plan_id IS NULL"
+                )
+                for plan in unlinked:
+                    razorpay_plan_id = find_razorpay_plan_id(plan['name'], plan['monthly_price'] * 100)
+                    if razorpay_plan_id and await conn.fetchval(
+                        LINK_RAZORPAY_PLAN_SQL, razorpay_plan_id, plan['id']
+                    ):
+                        logger.info("Linked plan %s to Razorpay plan %s", plan['id'], razorpay_plan_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Razorpay plan sync failed: %s", e)
+        await asyncio.sleep(RAZORPAY_PLAN_SYNC_SECONDS)
+
+def find_razorpay_plan_id(name: str, amount: int) -> Optional[str]:
+    """Look up a Razorpay plan id by (item name, amount in paise) in the synced index"""
+    return razorpay_plan_index.get((name, amount))
+
+# First link wins: a plan that is already linked keeps its Razorpay plan id
+LINK_RAZORPAY_PLAN_SQL = """
+    UPDATE plans
+    SET razorpay_plan_id = $1, updated_at = NOW()
+    WHERE id = $2 AND razorpay_plan_id IS NULL
+    RETURNING razorpay_plan_id
+"""
+
+async def link_razorpay_plan(conn, plan_id, razorpay_plan_id: str) -> str:
+    """Store the Razorpay plan id unless one is already linked; return the linked id"""
+    linked = await conn.fetchval(LINK_RAZORPAY_PLAN_SQL, razorpay_plan_id, plan_id)
+    if linked is None:
+        linked = await conn.fetchval("SELECT razorpay_plan_id FROM plans WHERE id = $1", plan_id)
+    return linked
+
+async def ensure_razorpay_plan(pool, plan) -> str:
+    """Create (or find) the Razorpay plan for a DB plan; one caller per plan does the work"""
+    # The asyncio lock queues this worker's callers; the advisory lock queues the other workers
+    async with razorpay_plan_locks[plan['id']], pool.acquire() as conn, conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1::text))", str(plan['id']))
+        # Another request may have linked the plan while we waited for the locks
+        razorpay_plan_id = await conn.fetchval("SELECT razorpay_plan_id FROM plans WHERE id = $1", plan['id'])
+        if razorpay_plan_id:
+            return razorpay_plan_id
+
+        # Create plan in Razorpay if not exists
+        try:
+            razorpay_plan_data = {
+                "period": "monthly",
+                "interval": 1,
+                "item": {
+                    "name": plan['name'],
+                    "amount": plan['monthly_price'] * 100,  # Convert to paise
+                    "currency": "INR"
+                },
+                "notes": {
+                    "plan_id": str(plan['id'])
+                }
+            }
+            
+            logger.debug("Creating Razorpay plan with data: %s", razorpay_plan_data)
+            razorpay_plan = await razorpay_client.create_plan(razorpay_plan_data)
+            razorpay_plan_index[(plan['name'], plan['monthly_price'] * 100)] = razorpay_plan["id"]
+            
+            # Update your database with the Razorpay plan ID
+            razorpay_plan_id = await link_razorpay_plan(conn, plan['id'], razorpay_plan["id"])
+            
+            logger.info("Razorpay plan created: %s", razorpay_plan["id"])
+            
+        except Exception as e:
+            logger.error("Error creating Razorpay plan: %s", e)
+            # If plan creation fails, try to find existing plan
+            try:
+                existing_plan_id = find_razorpay_plan_id(plan['name'], plan['monthly_price'] * 100)
+                
+                if existing_plan_id:
+                    razorpay_plan_id = await link_razorpay_plan(conn, plan['id'], existing_plan_id)
+                else:
+                    raise HTTPException(
+                        status_code=500, 
+                        detail=f"Failed to create or find Razorpay plan: {str(e)}"
+                    )
+            except Exception as fallback_error:
+                logger.error("Fallback plan search failed: %s", fallback_error)
+                raise HTTPException(
+                    status_code=500, 
+                    detail="Failed to create subscription plan"
+                )
+
+        return razorpay_plan_id
+
 # --- Payment/check logic ---
 async def check_payment_status(user_id: str, conn) -> tuple[bool, str]:
+    """Check if user has active payment and available sessions, using the local cache"""
+    cached = payment_status_cache.get(user_id)
+    if cached is not None:
+        return cached
+    inflight = payment_status_inflight.get(user_id)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    future = asyncio.get_running_loop().create_future()
+    payment_status_inflight[user_id] = future
+    try:
+        result = await fetch_payment_status(user_id, conn)
+        if result[1] not in PAYMENT_STATUS_ERRORS:
+            payment_status_cache[user_id] = result
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved when nobody else is waiting
+        raise
+    finally:
+        payment_status_inflight.pop(user_id, None)
+
+async def fetch_payment_status(user_id: str, conn) -> tuple[bool, str]:
     """Check if user has active payment and available sessions"""
     try:
-        payment = await conn.fetchrow("""
-            SELECT session_limit, session_used, status, end_at, next_billing_at, razorpay_subscription_id
-            FROM payments
-            WHERE user_id = $1 AND status IN ('active', 'past_due', 'active', 'created')
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, user_id)
+        payment = await conn.prepared[SELECT_LIVE_PAYMENT_SQL].fetchrow(user_id)
 
         if not payment:
             return False, "No active subscription found"
@@ -354,22 +1078,19 @@ async def check_payment_status(user_id: str, conn) -> tuple[bool, str]:
         if payment['status'] == 'created':
             try:
                 # Check current status with Razorpay
-                subscription = razorpay_client.subscription.fetch(payment['razorpay_subscription_id'])
+                subscription = await razorpay_client.fetch_subscription(payment['razorpay_subscription_id'])
                 razorpay_status = subscription.get('status')
                 
-                logger.info(f"Razorpay subscription status: {razorpay_status}")
+                logger.debug("Razorpay subscription status: %s", razorpay_status)
                 
                 # Update local status if Razorpay shows different status
                 if razorpay_status in ['authenticated', 'active']:
-                    await conn.execute("""
-                        UPDATE payments 
-                        SET status = 'active', updated_at = NOW()
-                        WHERE razorpay_subscription_id = $1
-                    """, payment['razorpay_subscription_id'])
+                    await update_subscription_status(conn, payment['razorpay_subscription_id'], 'active')
+                    await publish_payment_change(conn, user_id)
                     # Update payment dict for further checks
                     payment = dict(payment)
                     payment['status'] = 'active'
-                    logger.info(f"Updated local payment status to active for subscription {payment['razorpay_subscription_id']}")
+                    logger.info("Updated local payment status to active for subscription %s", payment['razorpay_subscription_id'])
                     
                 elif razorpay_status == 'pending':
                     return False, "Payment is pending - please complete the payment"
@@ -381,7 +1102,7 @@ async def check_payment_status(user_id: str, conn) -> tuple[bool, str]:
                     return False, f"Subscription status: {razorpay_status}"
                     
             except Exception as e:
-                logger.error(f"Error checking Razorpay status: {str(e)}")
+                logger.error("Error checking Razorpay status: %s", e)
                 return False, "Unable to verify subscription status"
         
         # Check if subscription has expired
@@ -405,215 +1126,144 @@ async def check_payment_status(user_id: str, conn) -> tuple[bool, str]:
         return False, "Subscription not active"
         
     except Exception as e:
-        logger.error(f"Error checking payment status: {str(e)}")
+        logger.error("Error checking payment status: %s", e)
         return False, "Error checking subscription status"
 
 # --- ROUTES ---
 @app.post("/api/users/profile/sync")
 async def sync_user_profile_from_token(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
+    request: Request,
     conn = Depends(get_db)
 ):
     try:
-        user_id, token_payload = await get_current_user_with_metadata(credentials)
+        user_id, token_payload = request.state.user_id, request.state.token_payload
         user_metadata = token_payload.get('user_metadata', {})
         if not user_metadata:
             user_metadata = token_payload.get('raw_user_meta_data', {})
         name = user_metadata.get('name', 'Anonymous')
         age = user_metadata.get('age')
-        logger.info(f"Syncing profile for user {user_id}: name={name}, age={age}")
-        await ensure_user_exists(conn, user_id, token_payload)
-        await conn.execute("""
-            UPDATE users
-            SET name = $1, age = $2, onboarding = 'Done', updated_at = NOW()
-            WHERE id = $3
-        """, name, age, user_id)
-        user_data = await conn.fetchrow("""
-            SELECT id, name, age, onboarding, created_at, updated_at
-            FROM users
-            WHERE id = $1
-        """, user_id)
-        if not user_data:
-            raise HTTPException(status_code=404, detail="User not found after sync")
-        return UserProfileResponse(
-            user_id=str(user_data['id']),
-            name=user_data['name'],
-            age=user_data['age'],
-            onboarding=user_data['onboarding'],
-            created_at=user_data['created_at'].isoformat(),
-            updated_at=user_data['updated_at'].isoformat()
-        )
+        logger.debug("Syncing profile for user %s: name=%s, age=%s", user_id, name, age)
+        # New users get their room from the create_room_for_new_user trigger
+        user_data = await conn.prepared[SYNC_USER_PROFILE_SQL].fetchrow(user_id, name, age)
+        # orjson encodes datetimes itself (same ISO format as isoformat())
+        profile: UserProfileResponse = dict(user_data)
+        return ORJSONResponse(profile)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error syncing user profile: {str(e)}")
+        logger.error("Error syncing user profile: %s", e)
         raise HTTPException(status_code=500, detail="Failed to sync user profile")
 
 @app.post("/api/users/setup")
 async def setup_user(
     user_data: UserCreate,
-    user_id: str = Depends(get_current_user),
+    request: Request,
     conn = Depends(get_db)
 ):
-    try:
-        room_id, room_name = await ensure_user_exists(
-            conn, user_id, user_data.model_dump()
-        )
-        await conn.execute("""
-            UPDATE users
-            SET name = $1, age = $2, onboarding = 'Done', updated_at = NOW()
-            WHERE id = $3
-        """, user_data.name, user_data.age, user_id)
-        return {
-            "user_id": user_id,
-            "room_id": room_id,
-            "room_name": room_name,
-            "status": "setup_complete"
-        }
-    except Exception as e:
-        logger.error(f"Error in user setup: {str(e)}")
-        raise HTTPException(status_code=500, detail="Setup failed")
+    user_id = request.state.user_id
+    room_id, room_name = await ensure_user_exists(
+        conn, user_id, user_data.model_dump()
+    )
+    await conn.execute("""
+        UPDATE users
+        SET name = $1, age = $2, onboarding = 'Done', updated_at = NOW()
+        WHERE id = $3
+    """, user_data.name, user_data.age, user_id)
+    return {
+        "user_id": user_id,
+        "room_id": room_id,
+        "room_name": room_name,
+        "status": "setup_complete"
+    }
 
 @app.post("/api/sessions/start")
 async def start_session(
-    user_id: str = Depends(get_current_user),
+    request: Request,
     conn = Depends(get_db)
 ):
-    try:
-        # 1. Check for an active subscription first.
-        is_subscribed, payment_message = await check_payment_status(user_id, conn)
+    user_id = request.state.user_id
+    # 1. Check for an active subscription first.
+    is_subscribed, payment_message = await check_payment_status(user_id, conn)
 
-        if is_subscribed:
-            # --- PAID USER LOGIC ---
-            logger.info(f"User {user_id} has an active subscription. Starting paid session.")
-            
-            # Ensure user and room exist
-            room_id, room_name = await ensure_user_exists(conn, user_id)
-            session_id = await create_session(conn, user_id, room_id)
-
-            # Increment paid session usage
-            await conn.execute(
-                """
-                UPDATE payments 
-                SET session_used = session_used + 1, updated_at = NOW() 
-                WHERE user_id = $1 AND status IN ('active', 'past_due')
-                """,
-                user_id
-            )
-            logger.info(f"Incremented paid session usage for user {user_id}")
+    if is_subscribed:
+        # --- PAID USER LOGIC ---
+        logger.debug("User %s has an active subscription. Starting paid session.", user_id)
+        
+        room_id, room_name, session_id = await create_paid_session(conn, user_id)
 
-        else:
-            # --- TRIAL USER LOGIC ---
-            logger.info(f"User {user_id} has no active subscription. Checking trial status.")
-            
-            # Fetch user's trial status
-            user = await conn.fetchrow("SELECT trial_seconds_used FROM users WHERE id = $1", user_id)
-            if not user:
-                 # This should be handled by ensure_user_exists, but as a safeguard:
-                await ensure_user_exists(conn, user_id)
-                user = await conn.fetchrow("SELECT trial_seconds_used FROM users WHERE id = $1", user_id)
-
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found.")
-            
-            # Check if trial is exhausted
-            if user['trial_seconds_used'] >= TRIAL_LIMIT_SECONDS:
-                logger.warning(f"User {user_id} has exhausted trial ({user['trial_seconds_used']}s) and has no subscription.")
-                raise HTTPException(status_code=403, detail="Your free trial has ended. Please subscribe to continue.")
-            
-            logger.info(f"User {user_id} has {TRIAL_LIMIT_SECONDS - user['trial_seconds_used']}s of trial remaining.")
-            
-            # Proceed with trial session
-            room_id, room_name = await ensure_user_exists(conn, user_id)
-            session_id = await create_session(conn, user_id, room_id)
-
-        # 5. If all checks pass, generate LiveKit token and return response
-        token = api.AccessToken(LIVEKIT_API_KEY, LIVEKIT_API_SECRET) \
-            .with_identity(user_id) \
-            .with_name(f"user_{user_id}") \
-            .with_grants(api.VideoGrants(room_join=True, room=room_name, room_create=True))
-
-        return SessionResponse(
-            session_id=session_id,
-            room_name=room_name,
-            room_id=room_id,
-            token=token.to_jwt(),
-            livekit_url=LIVEKIT_URL
-        )
+    else:
+        # --- TRIAL USER LOGIC ---
+        logger.debug("User %s has no active subscription. Checking trial status.", user_id)
+        
+        room_id, room_name, session_id = await create_trial_session(conn, user_id)
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error starting session: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to start session")
+    # 5. If all checks pass, generate LiveKit token and return response
+    token = generate_access_token(user_id, f"user_{user_id}", room_name)
+
+    response: SessionResponse = {
+        "session_id": session_id,
+        "room_name": room_name,
+        "room_id": room_id,
+        "token": token,
+        "livekit_url": LIVEKIT_URL
+    }
+    return ORJSONResponse(response)
 
 @app.post("/api/sessions/{session_id}/end")
 async def end_session_endpoint(
     session_id: str,
-    user_id: str = Depends(get_current_user),
+    request: Request,
     conn = Depends(get_db)
 ):
-    try:
-        await end_session(conn, session_id, user_id)
-        return {"status": "session_ended", "session_id": session_id}
-    except Exception as e:
-        logger.error(f"Error ending session: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to end session")
+    user_id = request.state.user_id
+    await end_session(conn, session_id, user_id)
+    return {"status": "session_ended", "session_id": session_id}
 
-@app.get("/api/users/room", response_model=RoomInfo)
+@app.get("/api/users/room")
 async def get_user_room(
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request
 ):
-    try:
-        # Join with users table to get trial usage
-        user_room_info = await conn.fetchrow("""
-            SELECT r.id, r.room_name, r.room_condition, u.trial_seconds_used
-            FROM room r
-            JOIN users u ON r.user_id = u.id
-            WHERE r.user_id = $1
-        """, user_id)
-
-        if not user_room_info:
-            # If user has no room, ensure one is created and re-fetch
+    user_id = request.state.user_id
+    pool = request.app.state.pool
+    # Join with users table to get trial usage; one pool-level query in the common case
+    user_room_info = await pool.fetchrow(SELECT_USER_ROOM_INFO_SQL, user_id)
+
+    if not user_room_info:
+        # If user has no room, ensure one is created and re-fetch
+        async with pool.acquire() as conn:
             await ensure_user_exists(conn, user_id)
-            user_room_info = await conn.fetchrow("""
-                SELECT r.id, r.room_name, r.room_condition, u.trial_seconds_used
-                FROM room r
-                JOIN users u ON r.user_id = u.id
-                WHERE r.user_id = $1
-            """, user_id)
-
-        if not user_room_info:
-             raise HTTPException(status_code=404, detail="Could not find or create room for user.")
-
-        return RoomInfo(
-            room_id=str(user_room_info['id']),
-            room_name=user_room_info['room_name'],
-            room_condition=user_room_info['room_condition'],
-            trial_seconds_used=user_room_info['trial_seconds_used']
-        )
-    except Exception as e:
-        logger.error(f"Error getting room info: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to get room info")
+            user_room_info = await conn.prepared[SELECT_USER_ROOM_INFO_SQL].fetchrow(user_id)
+
+    if not user_room_info:
+         raise HTTPException(status_code=404, detail="Could not find or create room for user.")
+
+    room_info: RoomInfo = {
+        "room_id": str(user_room_info['id']),
+        "room_name": user_room_info['room_name'],
+        "room_condition": user_room_info['room_condition'],
+        "trial_seconds_used": user_room_info['trial_seconds_used']
+    }
+    return ORJSONResponse(room_info)
 
 @app.get("/api/sessions/active")
 async def get_active_sessions(
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request,
+    limit: int = Query(default=50, ge=1, le=500),
+    before: Optional[datetime] = Query(default=None),
+    before_id: Optional[UUID] = Query(default=None)
 ):
+    user_id = request.state.user_id
+    if (before is None) != (before_id is None):
+        raise HTTPException(status_code=400, detail="before and before_id must be given together")
     try:
-        sessions = await conn.fetch("""
-            SELECT s.id, s.started_at, r.room_name, r.room_condition
-            FROM sessions s
-            JOIN room r ON s.room_id = r.id
-            WHERE s.user_id = $1 AND s.finished_at IS NULL
-            ORDER BY s.started_at DESC
-        """, user_id)
-        return [dict(session) for session in sessions]
+        # Postgres builds the JSON page; no per-row Python objects
+        body = await request.app.state.pool.fetchval(
+            SELECT_ACTIVE_SESSIONS_SQL, user_id, before, limit, before_id
+        )
     except Exception as e:
-        logger.error(f"Error getting active sessions: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to get active sessions")
+        logger.error("Error getting active sessions: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to fetch active sessions")
+    return Response(content=body, media_type="application/json")
 
 @app.get("/getToken", response_class=PlainTextResponse)
 def get_token(
@@ -622,115 +1272,138 @@ def get_token(
     name: str = Query(default="Anonymous")
 ):
     try:
-        token = api.AccessToken(
-            LIVEKIT_API_KEY,
-            LIVEKIT_API_SECRET
-        ).with_identity(identity) \
-         .with_name(name) \
-         .with_grants(api.VideoGrants(
-            room_join=True,
-            room=room,
-            room_create=True,
-        ))
-        return token.to_jwt()
+        return generate_access_token(identity, name, room)
     except Exception as e:
-        logger.error(f"Error generating token: {str(e)}")
+        logger.error("Error generating token: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": f"Failed to generate token: {str(e)}"}
         )
 
+# Static payloads, serialized once
+CONFIG_BODY = orjson.dumps({
+    "livekit_url": LIVEKIT_URL,
+    "server_status": "running"
+})
+CONFIG_ETAG = '"' + hashlib.sha256(CONFIG_BODY).hexdigest()[:16] + '"'
+HEALTH_BODY = orjson.dumps({"status": "healthy", "service": "livekit-backend-service"})
+PING_BODY = orjson.dumps({"message": "pong"})
+
+def _static_response(body: bytes) -> tuple[dict, dict]:
+    """Prebuilt ASGI start/body messages for a 200 JSON response"""
+    return (
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        },
+        {"type": "http.response.body", "body": body},
+    )
+
+# Served straight from StaticASGIMiddleware; the routes below only document them
+STATIC_RESPONSES = {
+    "/health": _static_response(HEALTH_BODY),
+    "/ping": _static_response(PING_BODY),
+}
+
 @app.get("/config")
-def get_config():
-    return {
-        "livekit_url": LIVEKIT_URL,
-        "server_status": "running"
-    }
+async def get_config(request: Request):
+    headers = {"ETag": CONFIG_ETAG, "Cache-Control": "public, max-age=30"}
+    if request.headers.get("if-none-match") == CONFIG_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(content=CONFIG_BODY, media_type="application/json", headers=headers)
 
 @app.get("/health")
-def health_check():
-    return {"status": "healthy", "service": "livekit-backend-service"}
+async def health_check():
+    return Response(content=HEALTH_BODY, media_type="application/json")
+
+@app.get("/healthz")
+async def pool_health(request: Request):
+    pool = request.app.state.pool
+    return {
+        "pool_size": pool.get_size(),
+        "pool_idle": pool.get_idle_size(),
+        "pool_min": pool.get_min_size(),
+        "pool_max": pool.get_max_size(),
+    }
 
 @app.get("/ping")
 async def ping():
-    return {"message": "pong"}
+    return Response(content=PING_BODY, media_type="application/json")
 
 @app.post("/livekit-webhook")
 async def livekit_webhook(request: Request):
-    try:
-        payload = await request.json()
-        event = payload.get("event")
-        room_name = payload.get("room", {}).get("name")
-        logger.info(f"Webhook event: {event} for room: {room_name}")
-        if event == "room_finished" and room_name:
-            stop_agent(room_name)
-        return {"status": "received"}
-    except Exception as e:
-        logger.error(f"Error handling webhook: {str(e)}")
+    body = await request.body()
+    if not verify_livekit_webhook(body, request.headers.get("Authorization")):
         return JSONResponse(
-            status_code=500,
-            content={"error": "Webhook handling failed"}
+            status_code=401,
+            content={"error": "Invalid webhook signature"}
         )
+    payload = orjson.loads(body)
+    event = payload.get("event")
+    room_name = payload.get("room", {}).get("name")
+    logger.debug("Webhook event: %s for room: %s", event, room_name)
+    # An agent's job ends with its room, so room_finished needs no cleanup here
+    return {"status": "received"}
 
 # --- Payment endpoints ---
-@app.get("/api/plans", response_model=list[PlanResponse])
-async def get_plans(conn = Depends(get_db)):
+# Serialized /api/plans body as (monotonic timestamp, bytes); plans rarely change
+PLANS_CACHE_TTL_SECONDS = 60
+plans_cache: Optional[tuple[float, bytes]] = None
+
+@app.get("/api/plans")
+async def get_plans(request: Request):
+    global plans_cache
+    if plans_cache and time.monotonic() - plans_cache[0] < PLANS_CACHE_TTL_SECONDS:
+        return Response(content=plans_cache[1], media_type="application/json")
     try:
-        plans = await conn.fetch("""
-            SELECT id, name, monthly_price, monthly_limit, created_at
-            FROM plans
-            ORDER BY monthly_price ASC
-        """)
-        return [
-            PlanResponse(
-                id=str(plan['id']),
-                name=plan['name'],
-                monthly_price=plan['monthly_price'],
-                monthly_limit=plan['monthly_limit'],
-                created_at=plan['created_at'].isoformat()
-            )
-            for plan in plans
-        ]
+        plans = await request.app.state.pool.fetch(SELECT_PLANS_SQL)
+        body = orjson.dumps([dict(plan) for plan in plans])
+        plans_cache = (time.monotonic(), body)
+        return Response(content=body, media_type="application/json")
     except Exception as e:
-        logger.error(f"Error fetching plans: {str(e)}")
+        logger.error("Error fetching plans: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch plans")
 
 @app.post("/api/payments/create-customer")
 async def create_razorpay_customer(
     customer_data: dict,
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request
 ):
+    user_id = request.state.user_id
     try:
-        user = await conn.fetchrow("SELECT name FROM users WHERE id = $1", user_id)
-        if not user:
+        # Pool-level query: no connection stays checked out during the Razorpay call
+        user_name = await request.app.state.pool.fetchval("SELECT name FROM users WHERE id = $1", user_id)
+        if user_name is None:
             raise HTTPException(status_code=404, detail="User not found")
         customer_data_razorpay = {
-            "name": user['name'],
+            "name": user_name,
             "email": customer_data.get("email"),
             "contact": customer_data.get("phone", ""),
             "notes": {
                 "user_id": user_id
             }
         }
-        customer = razorpay_client.customer.create(customer_data_razorpay)
+        customer = await razorpay_client.create_customer(customer_data_razorpay)
         return {
             "customer_id": customer["id"],
             "status": "created"
         }
     except Exception as e:
-        logger.error(f"Error creating Razorpay customer: {str(e)}")
+        logger.error("Error creating Razorpay customer: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create customer")
 
 @app.post("/api/payments/create-subscription")
 async def create_subscription(
     request: CreateSubscriptionRequest,
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    http_request: Request
 ):
+    user_id = http_request.state.user_id
+    # Each query runs directly on the pool, so no connection is pinned across Razorpay calls
+    pool = http_request.app.state.pool
     try:
         # Get plan details from your database
-        plan = await conn.fetchrow("""
+        plan = await pool.fetchrow("""
             SELECT id, name, monthly_price, monthly_limit, razorpay_plan_id
             FROM plans WHERE id = $1
         """, request.plan_id)
@@ -739,12 +1412,12 @@ async def create_subscription(
             raise HTTPException(status_code=404, detail="Plan not found")
 
         # Get user details
-        user = await conn.fetchrow("SELECT name FROM users WHERE id = $1", user_id)
-        if not user:
+        user_name = await pool.fetchval("SELECT name FROM users WHERE id = $1", user_id)
+        if user_name is None:
             raise HTTPException(status_code=404, detail="User not found")
 
         # Check if customer already exists in your database
-        existing_customer = await conn.fetchrow("""
+        existing_customer_id = await pool.fetchval("""
             SELECT razorpay_customer_id 
             FROM payments 
             WHERE user_id = $1 AND razorpay_customer_id IS NOT NULL
@@ -753,22 +1426,22 @@ async def create_subscription(
 
         customer_id = None
         
-        if existing_customer:
-            customer_id = existing_customer['razorpay_customer_id']
-            logger.info(f"Using existing customer: {customer_id}")
+        if existing_customer_id:
+            customer_id = existing_customer_id
+            logger.debug("Using existing customer: %s", customer_id)
             
             # Verify customer still exists in Razorpay
             try:
-                customer = razorpay_client.customer.fetch(customer_id)
-                logger.info(f"Existing customer verified: {customer_id}")
+                customer = await razorpay_client.fetch_customer(customer_id)
+                logger.debug("Existing customer verified: %s", customer_id)
             except Exception as e:
-                logger.warning(f"Existing customer {customer_id} not found in Razorpay: {str(e)}")
+                logger.warning("Existing customer %s not found in Razorpay: %s", customer_id, e)
                 customer_id = None
         
         # Create new customer if none exists or existing one is invalid
         if not customer_id:
             customer_data = {
-                "name": request.customer_name or user['name'],
+                "name": request.customer_name or user_name,
                 "email": request.customer_email,
                 "contact": "",  # Optional field
                 "notes": {
@@ -776,73 +1449,13 @@ async def create_subscription(
                 }
             }
             
-            logger.info(f"Creating new customer with data: {customer_data}")
-            customer = razorpay_client.customer.create(customer_data)
+            logger.debug("Creating new customer with data: %s", customer_data)
+            customer = await razorpay_client.create_customer(customer_data)
             customer_id = customer['id']
-            logger.info(f"New customer created: {customer_id}")
+            logger.info("New customer created: %s", customer_id)
 
         # Handle Razorpay plan creation/retrieval
-        razorpay_plan_id = plan.get('razorpay_plan_id')
-        
-        if not razorpay_plan_id:
-            # Create plan in Razorpay if not exists
-            try:
-                razorpay_plan_data = {
-                    "period": "monthly",
-                    "interval": 1,
-                    "item": {
-                        "name": plan['name'],
-                        "amount": plan['monthly_price'] * 100,  # Convert to paise
-                        "currency": "INR"
-                    },
-                    "notes": {
-                        "plan_id": str(plan['id'])
-                    }
-                }
-                
-                logger.info(f"Creating Razorpay plan with data: {razorpay_plan_data}")
-                razorpay_plan = razorpay_client.plan.create(razorpay_plan_data)
-                razorpay_plan_id = razorpay_plan["id"]
-                
-                # Update your database with the Razorpay plan ID
-                await conn.execute("""
-                    UPDATE plans 
-                    SET razorpay_plan_id = $1, updated_at = NOW()
-                    WHERE id = $2
-                """, razorpay_plan_id, plan['id'])
-                
-                logger.info(f"Razorpay plan created: {razorpay_plan_id}")
-                
-            except Exception as e:
-                logger.error(f"Error creating Razorpay plan: {str(e)}")
-                # If plan creation fails, try to find existing plan
-                try:
-                    plans = razorpay_client.plan.all()
-                    existing_plan = None
-                    for rp in plans['items']:
-                        if (rp['item']['name'] == plan['name'] and 
-                            rp['item']['amount'] == plan['monthly_price'] * 100):
-                            existing_plan = rp
-                            break
-                    
-                    if existing_plan:
-                        razorpay_plan_id = existing_plan['id']
-                        await conn.execute("""
-                            UPDATE plans 
-                            SET razorpay_plan_id = $1, updated_at = NOW()
-                            WHERE id = $2
-                        """, razorpay_plan_id, plan['id'])
-                    else:
-                        raise HTTPException(
-                            status_code=500, 
-                            detail=f"Failed to create or find Razorpay plan: {str(e)}"
-                        )
-                except Exception as fallback_error:
-                    logger.error(f"Fallback plan search failed: {str(fallback_error)}")
-                    raise HTTPException(
-                        status_code=500, 
-                        detail="Failed to create subscription plan"
-                    )
+        razorpay_plan_id = plan.get('razorpay_plan_id') or await ensure_razorpay_plan(pool, plan)
 
         # Create subscription
         subscription_data = {
@@ -858,27 +1471,27 @@ async def create_subscription(
             }
         }
         
-        logger.info(f"Creating subscription with data: {subscription_data}")
-        subscription = razorpay_client.subscription.create(subscription_data)
-        logger.info(f"Subscription created: {subscription['id']}")
+        logger.debug("Creating subscription with data: %s", subscription_data)
+        subscription = await razorpay_client.create_subscription(subscription_data)
+        logger.info("Subscription created: %s", subscription['id'])
 
-        # Store in database
-        start_at = datetime.utcnow()
-        next_billing_at = start_at + timedelta(days=30)
-        
-        payment_id = await conn.fetchval("""
+        # Store in database; the billing window starts now. start_at/next_billing_at are
+        # TIMESTAMP columns compared against datetime.utcnow(), so write them as UTC
+        payment_id = await pool.fetchval("""
             INSERT INTO payments (
                 user_id, plan_id, razorpay_customer_id, razorpay_subscription_id,
                 status, session_limit, session_used, start_at, next_billing_at
             )
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+            VALUES ($1, $2, $3, $4, $5, $6, $7,
+                    (NOW() AT TIME ZONE 'UTC'), (NOW() AT TIME ZONE 'UTC') + INTERVAL '30 days')
             RETURNING id
         """, 
             user_id, request.plan_id, customer_id, subscription["id"],
             "created",  # Initial status
-            plan['monthly_limit'], 0, start_at, next_billing_at
+            plan['monthly_limit'], 0
         )
 
+        await publish_payment_change(pool, user_id)
         return {
             "subscription_id": subscription["id"],
             "payment_id": str(payment_id),
@@ -891,129 +1504,159 @@ async def create_subscription(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error creating subscription: {str(e)}")
-        logger.error(f"Exception type: {type(e)}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Error creating subscription: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create subscription: {str(e)}")
-@app.get("/api/payments/current", response_model=PaymentResponse)
+
+@app.get("/api/payments/current")
 async def get_current_payment(
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request
 ):
+    user_id = request.state.user_id
     try:
-        payment = await conn.fetchrow("""
-            SELECT p.*, pl.name as plan_name
-            FROM payments p
-            LEFT JOIN plans pl ON p.plan_id = pl.id
-            WHERE p.user_id = $1 AND p.status = 'active'
-            ORDER BY p.created_at DESC
-            LIMIT 1
-        """, user_id)
+        payment = await request.app.state.pool.fetchrow(SELECT_ACTIVE_PAYMENT_SQL, user_id)
 
         if not payment:
             raise HTTPException(status_code=404, detail="No active payment found")
         
-        return PaymentResponse(
-            id=str(payment['id']),
-            user_id=str(payment['user_id']),
-            plan_id=str(payment['plan_id']) if payment['plan_id'] else None,
-            razorpay_customer_id=payment['razorpay_customer_id'],
-            razorpay_subscription_id=payment['razorpay_subscription_id'],
-            status=payment['status'],
-            session_limit=payment['session_limit'],
-            session_used=payment['session_used'],
-            start_at=payment['start_at'].isoformat(),
-            end_at=payment['end_at'].isoformat() if payment['end_at'] else None,
-            next_billing_at=payment['next_billing_at'].isoformat() if payment['next_billing_at'] else None,
-            created_at=payment['created_at'].isoformat(),
-            updated_at=payment['updated_at'].isoformat()
-        )
+        # orjson encodes UUIDs and datetimes itself (same ISO format as isoformat())
+        body: PaymentResponse = dict(payment)
+        return ORJSONResponse(body)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error fetching current payment: {str(e)}")
+        logger.error("Error fetching current payment: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch payment details")
 
+# Rows per cursor round trip while streaming payment history
+PAYMENT_HISTORY_BATCH_SIZE = 200
+
 @app.get("/api/payments/history")
 async def get_payment_history(
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request
 ):
+    user_id = request.state.user_id
+    pool = request.app.state.pool
+    conn = await pool.acquire()
+    tr = conn.transaction()
+    started = released = False
+
+    async def release():
+        # Either the stream's cleanup or the post-response task gets here first;
+        # end the cursor's transaction before handing the connection back
+        nonlocal released
+        if not released:
+            released = True
+            try:
+                if started:
+                    await tr.rollback()
+            finally:
+                await pool.release(conn)
+
+    # Fetch the first batch up front so early failures still surface as a 500
     try:
-        payments = await conn.fetch("""
-            SELECT p.*, pl.name as plan_name
-            FROM payments p
-            LEFT JOIN plans pl ON p.plan_id = pl.id
-            WHERE p.user_id = $1
-            ORDER BY p.created_at DESC
-        """, user_id)
-        return [
-            {
-                "id": str(payment['id']),
-                "plan_name": payment['plan_name'],
-                "status": payment['status'],
-                "session_limit": payment['session_limit'],
-                "session_used": payment['session_used'],
-                "start_at": payment['start_at'].isoformat(),
-                "end_at": payment['end_at'].isoformat() if payment['end_at'] else None,
-                "created_at": payment['created_at'].isoformat()
-            }
-            for payment in payments
-        ]
+        await tr.start()
+        started = True
+        cursor = await conn.prepared[SELECT_PAYMENT_HISTORY_SQL].cursor(user_id)
+        batch = await cursor.fetch(PAYMENT_HISTORY_BATCH_SIZE)
     except Exception as e:
-        logger.error(f"Error fetching payment history: {str(e)}")
+        await release()
+        logger.error("Error fetching payment history: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch payment history")
 
+    # Most histories fit in one batch: give the connection back before streaming so
+    # only long histories hold a pool slot for the client's read time
+    if len(batch) < PAYMENT_HISTORY_BATCH_SIZE:
+        await release()
+
+    async def stream_payments(batch):
+        # Emit a JSON array row by row; an error mid-stream propagates and aborts the
+        # response rather than closing the array as if it were complete
+        try:
+            yield b"["
+            separator = b""
+            while batch:
+                for payment in batch:
+                    yield separator + orjson.dumps(dict(payment))
+                    separator = b","
+                if len(batch) < PAYMENT_HISTORY_BATCH_SIZE:
+                    break
+                batch = await cursor.fetch(PAYMENT_HISTORY_BATCH_SIZE)
+            yield b"]"
+        finally:
+            await release()
+
+    return StreamingResponse(
+        stream_payments(batch), media_type="application/json", background=BackgroundTask(release)
+    )
+
 @app.post("/api/payments/cancel-subscription")
 async def cancel_subscription(
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request
 ):
+    user_id = request.state.user_id
+    # Pool-level calls: no connection stays checked out during the Razorpay call
+    pool = request.app.state.pool
     try:
-        payment = await conn.fetchrow("""
-            SELECT razorpay_subscription_id, id
-            FROM payments
-            WHERE user_id = $1 AND status = 'active'
-            ORDER BY created_at DESC
-            LIMIT 1
+        # Claim the newest active payment; SKIP LOCKED keeps concurrent cancels from racing
+        payment = await pool.fetchrow("""
+            UPDATE payments
+            SET status = 'cancel_pending', updated_at = NOW()
+            WHERE id = (
+                SELECT id FROM payments
+                WHERE user_id = $1 AND status = 'active'
+                ORDER BY created_at DESC
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, razorpay_subscription_id
         """, user_id)
         if not payment:
             raise HTTPException(status_code=404, detail="No active subscription found")
-        razorpay_client.subscription.cancel(payment['razorpay_subscription_id'])
-        await conn.execute("""
-            UPDATE payments
-            SET status = 'cancelled', updated_at = NOW()
-            WHERE id = $1
-        """, payment['id'])
+        await publish_payment_change(pool, user_id)
+        status = 'active'
+        try:
+            await razorpay_client.cancel_subscription(payment['razorpay_subscription_id'])
+            status = 'cancelled'
+        finally:
+            # Cancelled on success; back to active if Razorpay refused
+            async with pool.acquire() as conn:
+                await update_subscription_status(conn, payment['razorpay_subscription_id'], status)
+                await publish_payment_change(conn, user_id)
         return {"status": "cancelled", "message": "Subscription cancelled successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error cancelling subscription: {str(e)}")
+        logger.error("Error cancelling subscription: %s", e)
         raise HTTPException(status_code=500, detail="Failed to cancel subscription")
 
 @app.post("/api/payments/usage/increment")
 async def increment_session_usage(
-    user_id: str = Depends(get_current_user),
+    request: Request,
     conn = Depends(get_db)
 ):
+    user_id = request.state.user_id
     try:
+        # Check the cap and increment in one statement so concurrent calls cannot overshoot
         payment = await conn.fetchrow("""
-            SELECT id, session_limit, session_used
-            FROM payments
-            WHERE user_id = $1 AND status = 'active'
-            ORDER BY created_at DESC
-            LIMIT 1
+            UPDATE payments
+            SET session_used = session_used + 1, updated_at = NOW()
+            WHERE id = (
+                SELECT id FROM payments
+                WHERE user_id = $1 AND status = 'active'
+                ORDER BY created_at DESC
+                LIMIT 1
+            ) AND session_used < session_limit
+            RETURNING session_used, session_limit
         """, user_id)
         if not payment:
-            raise HTTPException(status_code=404, detail="No active payment plan found")
-        if payment['session_used'] >= payment['session_limit']:
+            has_plan = await conn.fetchval(
+                "SELECT EXISTS(SELECT 1 FROM payments WHERE user_id = $1 AND status = 'active')", user_id
+            )
+            if not has_plan:
+                raise HTTPException(status_code=404, detail="No active payment plan found")
             raise HTTPException(status_code=403, detail="Session limit exceeded")
-        new_usage = await conn.fetchval("""
-            UPDATE payments
-            SET session_used = session_used + 1, updated_at = NOW()
-            WHERE id = $1
-            RETURNING session_used
-        """, payment['id'])
+        new_usage = payment['session_used']
+        await publish_payment_change(conn, user_id)
         return {
             "session_used": new_usage,
             "session_limit": payment['session_limit'],
@@ -1022,357 +1665,299 @@ async def increment_session_usage(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error incrementing session usage: {str(e)}")
+        logger.error("Error incrementing session usage: %s", e)
         raise HTTPException(status_code=500, detail="Failed to update usage")
 
 @app.get("/api/payments/usage")
 async def get_usage_stats(
-    user_id: str = Depends(get_current_user),
-    conn = Depends(get_db)
+    request: Request
 ):
+    user_id = request.state.user_id
+    body = usage_cache.get(user_id)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
     try:
-        payment = await conn.fetchrow("""
-            SELECT session_limit, session_used, status, next_billing_at
-            FROM payments
-            WHERE user_id = $1 AND status = 'active'
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, user_id)
+        payment = await request.app.state.pool.fetchrow(SELECT_USAGE_SQL, user_id)
         if not payment:
-            return {
+            usage = {
                 "session_limit": 0,
                 "session_used": 0,
                 "remaining": 0,
                 "status": "no_plan",
                 "next_billing_at": None
             }
-        remaining = payment['session_limit'] - payment['session_used']
-        return {
-            "session_limit": payment['session_limit'],
-            "session_used": payment['session_used'],
-            "remaining": remaining,
-            "status": payment['status'],
-            "next_billing_at": payment['next_billing_at'].isoformat() if payment['next_billing_at'] else None
-        }
+        else:
+            usage = {
+                "session_limit": payment['session_limit'],
+                "session_used": payment['session_used'],
+                "remaining": payment['session_limit'] - payment['session_used'],
+                "status": payment['status'],
+                "next_billing_at": payment['next_billing_at']
+            }
+        body = usage_cache[user_id] = orjson.dumps(usage)
+        return Response(content=body, media_type="application/json")
     except Exception as e:
-        logger.error(f"Error fetching usage stats: {str(e)}")
+        logger.error("Error fetching usage stats: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch usage statistics")
 
 @app.post("/api/payments/webhook")
-async def razorpay_webhook(request: Request, conn = Depends(get_db)):
+async def razorpay_webhook(request: Request):
+    body = await request.body()
+    signature = request.headers.get('X-Razorpay-Signature')
+
+    # Only verify with webhook secret, not API secret
+    if not signature or not verify_razorpay_signature(body, signature, RAZORPAY_WEBHOOK_SECRET_BYTES):
+        logger.error("Invalid webhook signature")
+        raise HTTPException(status_code=400, detail="Invalid signature")
+
+    # Razorpay retries deliveries until it gets a 2xx. The event id is claimed in the same
+    # transaction as the payment writes, so it is only recorded once they commit, and a
+    # retry landing on any worker sees it.
+    event_id = request.headers.get('X-Razorpay-Event-Id') or hashlib.sha256(body).hexdigest()
     try:
-        body = await request.body()
-        signature = request.headers.get('X-Razorpay-Signature')
-
-        # Only verify with webhook secret, not API secret
-        if not signature or not verify_razorpay_signature(body, signature, RAZORPAY_WEBHOOK_SECRET):
-            logger.error("Invalid webhook signature")
-            raise HTTPException(status_code=400, detail="Invalid signature")
-        
-        payload = await request.json()
-        event = payload.get('event')
-        
-        logger.info(f"Received webhook event: {event}")
-        logger.info(f"Full payload: {payload}")
-        
-        # Extract entity data based on the correct Razorpay webhook structure
-        subscription_data = None
-        payment_data = None
-        subscription_id = None
-        
-        # Handle the nested structure correctly
-        payload_data = payload.get('payload', {})
-        
-        # For subscription events
-        if 'subscription' in payload_data:
-            subscription_payload = payload_data['subscription']
-            # Handle both possible structures
-            if 'entity' in subscription_payload:
-                subscription_data = subscription_payload['entity']
-            else:
-                subscription_data = subscription_payload
-            subscription_id = subscription_data.get('id')
-        
-        # For payment events
-        if 'payment' in payload_data:
-            payment_payload = payload_data['payment']
-            if 'entity' in payment_payload:
-                payment_data = payment_payload['entity']
-            else:
-                payment_data = payment_payload
-            
-            # For payment events, we might need to get subscription ID from payment data
-            if not subscription_id:
-                subscription_id = payment_data.get('subscription_id')
-        
-        # Alternative extraction method for direct entity structure
-        if not subscription_id:
-            entity_data = payload_data.get('entity', {})
-            if entity_data.get('entity') == 'subscription':
-                subscription_data = entity_data
-                subscription_id = entity_data.get('id')
-        
-        logger.info(f"Extracted subscription ID: {subscription_id}")
-        logger.info(f"Subscription data: {subscription_data}")
-        
-        if not subscription_id:
-            logger.warning("No subscription ID found in webhook payload")
-            logger.warning(f"Payload structure: {payload}")
-            return {"status": "ignored", "reason": "no subscription id"}
-        
-        # Handle different webhook events
-        if event == 'subscription.activated':
-            await handle_subscription_activated(conn, subscription_id, subscription_data)
-            
-        elif event == 'subscription.charged':
-            await handle_subscription_charged(conn, subscription_id, subscription_data, payment_data)
-            
-        elif event == 'subscription.authenticated':
-            # This event fires when subscription is created and authenticated
-            await handle_subscription_authenticated(conn, subscription_id, subscription_data)
-            
-        elif event == 'subscription.charge_failed':
-            await handle_charge_failed(conn, subscription_id, subscription_data)
-            
-        elif event == 'subscription.cancelled':
-            await handle_subscription_cancelled(conn, subscription_id)
-            
-        elif event == 'subscription.completed':
-            # Map completed to cancelled since you don't have 'completed' in enum
-            await handle_subscription_cancelled(conn, subscription_id)
-            
-        elif event == 'subscription.paused':
-            await handle_subscription_paused(conn, subscription_id)
-            
-        elif event == 'subscription.resumed':
-            await handle_subscription_resumed(conn, subscription_id)
-        
-        else:
-            logger.info(f"Unhandled webhook event: {event}")
-        
-        return {"status": "processed", "event": event}
-        
-    except HTTPException:
-        raise
+        async with request.app.state.pool.acquire() as conn, conn.transaction():
+            if await conn.fetchval(CLAIM_WEBHOOK_EVENT_SQL, event_id) is None:
+                logger.info("Duplicate webhook event %s, skipping", event_id)
+                return {"status": "duplicate"}
+            await process_razorpay_event(conn, orjson.loads(body))
     except Exception as e:
-        logger.error(f"Error processing webhook: {str(e)}")
-        logger.error(f"Request body: {body}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        # Not acknowledged, so Razorpay redelivers it
+        logger.exception("Error processing webhook: %s", e)
+        logger.debug("Request body: %s", body)
         raise HTTPException(status_code=500, detail="Webhook processing failed")
-
-async def handle_subscription_authenticated(conn, subscription_id: str, subscription_data: dict):
+    return {"status": "processed"}
+
+async def process_razorpay_event(conn, payload: dict):
+    """Apply a verified Razorpay webhook payload to the payments table; errors propagate"""
+    event = payload.get('event')
+    # Handlers key on subscription id, not user id, so drop every cached status
+    await publish_payment_change(conn)
+    
+    logger.debug("Received webhook event: %s", event)
+    logger.debug("Full payload: %s", payload)
+    
+    # Extract entity data based on the correct Razorpay webhook structure
+    subscription_data = None
+    payment_data = None
+    subscription_id = None
+    
+    # Handle the nested structure correctly
+    payload_data = payload.get('payload', {})
+    
+    # For subscription events
+    if 'subscription' in payload_data:
+        subscription_payload = payload_data['subscription']
+        # Handle both possible structures
+        if 'entity' in subscription_payload:
+            subscription_data = subscription_payload['entity']
+        else:
+            subscription_data = subscription_payload
+        subscription_id = subscription_data.get('id')
+    
+    # For payment events
+    if 'payment' in payload_data:
+        payment_payload = payload_data['payment']
+        if 'entity' in payment_payload:
+            payment_data = payment_payload['entity']
+        else:
+            payment_data = payment_payload
+        
+        # For payment events, we might need to get subscription ID from payment data
+        if not subscription_id:
+            subscription_id = payment_data.get('subscription_id')
+    
+    # Alternative extraction method for direct entity structure
+    if not subscription_id:
+        entity_data = payload_data.get('entity', {})
+        if entity_data.get('entity') == 'subscription':
+            subscription_data = entity_data
+            subscription_id = entity_data.get('id')
+    
+    logger.debug("Extracted subscription ID: %s", subscription_id)
+    logger.debug("Subscription data: %s", subscription_data)
+    
+    if not subscription_id:
+        logger.warning("No subscription ID found in webhook payload")
+        logger.debug("Payload structure: %s", payload)
+        return
+    
+    handler = WEBHOOK_HANDLERS.get(event)
+    if handler is None:
+        logger.info("Unhandled webhook event: %s", event)
+        return
+    await handler(conn, subscription_id, subscription_data, payment_data)
+
+async def handle_subscription_authenticated(conn, subscription_id: str, subscription_data: Optional[dict], payment_data: Optional[dict]):
     """Handle subscription authentication (moves from created to active)"""
-    try:
-        # Log the subscription data for debugging
-        logger.info(f"Processing authentication for subscription {subscription_id}")
-        logger.info(f"Subscription status in webhook: {subscription_data.get('status') if subscription_data else 'No data'}")
-
-        # Update status to active when subscription is authenticated
-        # Note: Using only valid enum values from your database
-        result = await conn.execute("""
-            UPDATE payments 
-            SET status = 'active', updated_at = NOW()
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
+    # Log the subscription data for debugging
+    logger.debug("Processing authentication for subscription %s", subscription_id)
+    logger.debug("Subscription status in webhook: %s", subscription_data.get('status') if subscription_data else 'No data')
+
+    # Update status to active when subscription is authenticated
+    # Note: Using only valid enum values from your database
+    rows_updated = await update_subscription_status(conn, subscription_id, 'active')
+    
+    if rows_updated > 0:
+        logger.info("Subscription %s activated via authentication event - %s rows updated", subscription_id, rows_updated)
+    else:
+        logger.warning("No payment record found for subscription %s in created/authenticated status", subscription_id)
         
-        # Check how many rows were updated
-        rows_updated = int(result.split()[-1]) if result.startswith('UPDATE') else 0
+        # Debug: Check if the subscription exists with a different status
+        existing_status = await conn.fetchval(
+            "SELECT status FROM payments WHERE razorpay_subscription_id = $1", subscription_id
+        )
         
-        if rows_updated > 0:
-            logger.info(f"Subscription {subscription_id} activated via authentication event - {rows_updated} rows updated")
+        if existing_status is not None:
+            logger.info("Found existing payment record with status: %s", existing_status)
+            # If it exists but with wrong status, let's update it anyway
+            if existing_status == 'created':
+                await update_subscription_status(conn, subscription_id, 'active')
+                logger.info("Force updated subscription %s to active status", subscription_id)
         else:
-            logger.warning(f"No payment record found for subscription {subscription_id} in created/authenticated status")
-            
-            # Debug: Check if the subscription exists with a different status
-            existing_payment = await conn.fetchrow("""
-                SELECT id, user_id, status, razorpay_subscription_id 
-                FROM payments 
-                WHERE razorpay_subscription_id = $1
-            """, subscription_id)
-            
-            if existing_payment:
-                logger.info(f"Found existing payment record with status: {existing_payment['status']}")
-                # If it exists but with wrong status, let's update it anyway
-                if existing_payment['status'] in ['created']:
-                    await conn.execute("""
-                        UPDATE payments 
-                        SET status = 'active', updated_at = NOW()
-                        WHERE razorpay_subscription_id = $1
-                    """, subscription_id)
-                    logger.info(f"Force updated subscription {subscription_id} to active status")
-            else:
-                logger.error(f"No payment record found at all for subscription {subscription_id}")
-            
-    except Exception as e:
-        logger.error(f"Error handling subscription authentication: {str(e)}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+            logger.error("No payment record found at all for subscription %s", subscription_id)
 
-async def handle_subscription_activated(conn, subscription_id: str, subscription_data: dict):
+async def handle_subscription_activated(conn, subscription_id: str, subscription_data: Optional[dict], payment_data: Optional[dict]):
     """Handle subscription activation"""
-    try:
-        if not subscription_data:
-            logger.warning(f"No subscription data provided for activation of {subscription_id}")
-            return
+    if not subscription_data:
+        logger.warning("No subscription data provided for activation of %s", subscription_id)
+        return
 
-        start_time = subscription_data.get('start_at')
-        if start_time:
-            start_dt = datetime.fromtimestamp(start_time, tz=timezone.utc)
-        else:
-            start_dt = datetime.now(timezone.utc)
-        
-        result = await conn.execute("""
-            UPDATE payments 
-            SET status = 'active', start_at = $1, updated_at = NOW()
-            WHERE razorpay_subscription_id = $2
-        """, start_dt, subscription_id)
-        
-        rows_updated = int(result.split()[-1]) if result.startswith('UPDATE') else 0
-        logger.info(f"Subscription {subscription_id} activated, rows affected: {rows_updated}")
-        
-    except Exception as e:
-        logger.error(f"Error activating subscription {subscription_id}: {str(e)}")
+    start_time = subscription_data.get('start_at')
+    if start_time:
+        start_dt = datetime.fromtimestamp(start_time, tz=timezone.utc)
+    else:
+        start_dt = datetime.now(timezone.utc)
+    
+    rows_updated = await activate_subscription(conn, subscription_id, start_dt)
+    logger.info("Subscription %s activated, rows affected: %s", subscription_id, rows_updated)
 
-async def handle_subscription_charged(conn, subscription_id: str, subscription_data: dict, payment_data: dict):
+async def handle_subscription_charged(conn, subscription_id: str, subscription_data: Optional[dict], payment_data: Optional[dict]):
     """Handle successful subscription charge"""
-    try:
-        if not subscription_data:
-            logger.warning(f"No subscription data provided for charge of {subscription_id}")
-            return
-
-        next_billing = subscription_data.get('next_billing_at')
-        amount = payment_data.get('amount', 0) if payment_data else 0
-        
-        # Get current payment record to check if we should reset sessions
-        current_payment = await conn.fetchrow("""
-            SELECT session_used, session_limit, last_reset_at, status
-            FROM payments 
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
-        
-        if not current_payment:
-            logger.error(f"No payment record found for subscription {subscription_id}")
-            return
-        
-        # Determine if this is a new billing cycle
-        should_reset_sessions = True
-        if current_payment['last_reset_at']:
-            # Check if we've already reset sessions for this billing cycle
-            last_reset = current_payment['last_reset_at']
-            if (datetime.now(timezone.utc) - last_reset).days < 25:  # Less than 25 days since last reset
-                should_reset_sessions = False
-        
-        update_query = """
-            UPDATE payments 
-            SET status = 'active', 
-                next_billing_at = $1,
-                last_payment_amount = $2,
-                last_payment_at = NOW(),
-                updated_at = NOW()
-        """
-        params = [datetime.fromtimestamp(next_billing, tz=timezone.utc) if next_billing else None, amount]
-        
-        if should_reset_sessions:
-            update_query += ", session_used = 0, last_reset_at = NOW()"
-        
-        update_query += " WHERE razorpay_subscription_id = $3"
-        params.append(subscription_id)
-        
-        result = await conn.execute(update_query, *params)
-        
-        rows_updated = int(result.split()[-1]) if result.startswith('UPDATE') else 0
-        logger.info(f"Subscription {subscription_id} charged successfully. Sessions reset: {should_reset_sessions}, rows affected: {rows_updated}")
-        
-    except Exception as e:
-        logger.error(f"Error handling subscription charge for {subscription_id}: {str(e)}")
-
-async def handle_charge_failed(conn, subscription_id: str, subscription_data: dict):
-    """Handle failed subscription charge"""
-    try:
-        await conn.execute("""
-            UPDATE payments
-            SET status = 'failed', updated_at = NOW()
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
-
-        # Optional: Send notification to user about failed payment
-        logger.warning(f"Subscription {subscription_id} charge failed - marked as failed")
-    except Exception as e:
-        logger.error(f"Error handling charge failed for {subscription_id}: {str(e)}")
-
-async def handle_subscription_cancelled(conn, subscription_id: str):
-    """Handle subscription cancellation"""
-    try:
-        await conn.execute("""
-            UPDATE payments
-            SET status = 'cancelled', end_at = NOW(), updated_at = NOW()
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
-
-        logger.info(f"Subscription {subscription_id} cancelled")
-    except Exception as e:
-        logger.error(f"Error handling subscription cancellation for {subscription_id}: {str(e)}")
-
-async def handle_subscription_completed(conn, subscription_id: str):
-    """Handle subscription completion (natural end)"""
-    try:
-        # Map completed to cancelled since you don't have 'completed' in enum
-        await conn.execute("""
-            UPDATE payments
-            SET status = 'cancelled', end_at = NOW(), updated_at = NOW()
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
-
-        logger.info(f"Subscription {subscription_id} completed")
-    except Exception as e:
-        logger.error(f"Error handling subscription completion for {subscription_id}: {str(e)}")
-
-async def handle_subscription_paused(conn, subscription_id: str):
-    """Handle subscription pause"""
-    try:
-        await conn.execute("""
-            UPDATE payments
-            SET status = 'paused', updated_at = NOW()
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
-
-        logger.info(f"Subscription {subscription_id} paused")
-    except Exception as e:
-        logger.error(f"Error handling subscription pause for {subscription_id}: {str(e)}")
-
-async def handle_subscription_resumed(conn, subscription_id: str):
-    """Handle subscription resume"""
-    try:
-        await conn.execute("""
-            UPDATE payments
-            SET status = 'active', updated_at = NOW()
-            WHERE razorpay_subscription_id = $1
-        """, subscription_id)
-
-        logger.info(f"Subscription {subscription_id} resumed")
-    except Exception as e:
-        logger.error(f"Error handling subscription resume for {subscription_id}: {str(e)}")
+    if not subscription_data:
+        logger.warning("No subscription data provided for charge of %s", subscription_id)
+        return
+
+    next_billing = subscription_data.get('next_billing_at')
+    amount = payment_data.get('amount', 0) if payment_data else 0
+    
+    # New billing cycle (no reset in the last 25 days) resets session usage, decided in SQL
+    rows = await conn.fetch("""
+        UPDATE payments 
+        SET status = 'active', 
+            next_billing_at = $1,
+            last_payment_amount = $2,
+            last_payment_at = NOW(),
+            session_used = CASE WHEN last_reset_at IS NULL OR NOW() - last_reset_at >= INTERVAL '25 days'
+                                THEN 0 ELSE session_used END,
+            last_reset_at = CASE WHEN last_reset_at IS NULL OR NOW() - last_reset_at >= INTERVAL '25 days'
+                                 THEN NOW() ELSE last_reset_at END,
+            updated_at = NOW()
+        WHERE razorpay_subscription_id = $3
+        RETURNING last_reset_at = NOW() AS sessions_reset
+    """,
+        datetime.fromtimestamp(next_billing, tz=timezone.utc) if next_billing else None,
+        amount,
+        subscription_id
+    )
+    
+    if not rows:
+        logger.error("No payment record found for subscription %s", subscription_id)
+        return
+    
+    logger.info("Subscription %s charged successfully. Sessions reset: %s, rows affected: %s", subscription_id, rows[0]['sessions_reset'], len(rows))
+
+def subscription_status_handler(status: str, action: str, ends: bool = False):
+    """Build a webhook handler that only moves a subscription to `status`"""
+    async def handler(conn, subscription_id: str, subscription_data: Optional[dict], payment_data: Optional[dict]):
+        if ends:
+            rows_updated = await end_subscription(conn, subscription_id)
+        else:
+            rows_updated = await update_subscription_status(conn, subscription_id, status)
+        logger.info("Subscription %s %s - marked as %s, rows affected: %s", subscription_id, action, status, rows_updated)
+    return handler
+
+# Razorpay event name -> handler(conn, subscription_id, subscription_data, payment_data)
+WEBHOOK_HANDLERS = {
+    'subscription.activated': handle_subscription_activated,
+    'subscription.charged': handle_subscription_charged,
+    # This event fires when subscription is created and authenticated
+    'subscription.authenticated': handle_subscription_authenticated,
+    'subscription.charge_failed': subscription_status_handler('failed', 'charge failed'),
+    'subscription.cancelled': subscription_status_handler('cancelled', 'cancelled', ends=True),
+    # Map completed to cancelled since you don't have 'completed' in enum
+    'subscription.completed': subscription_status_handler('cancelled', 'completed', ends=True),
+    'subscription.paused': subscription_status_handler('paused', 'paused'),
+    'subscription.resumed': subscription_status_handler('active', 'resumed'),
+}
+
+# --- Bulk payment writes (webhook replay / reconciliation) ---
+PAYMENT_COLUMNS = [
+    "user_id", "plan_id", "razorpay_customer_id", "razorpay_subscription_id",
+    "status", "session_limit", "session_used", "start_at", "next_billing_at",
+]
+PAYMENT_COPY_THRESHOLD = 500
+
+async def sync_payment_statuses(conn, updates: list[tuple[str, str]]):
+    """Apply (status, razorpay_subscription_id) pairs in one pipelined batch"""
+    if not updates:
+        return
+    await conn.executemany("""
+        UPDATE payments
+        SET status = $1, updated_at = NOW()
+        WHERE razorpay_subscription_id = $2
+    """, updates)
+    await publish_payment_change(conn)
+
+async def insert_payments(conn, records: list[tuple]):
+    """Insert payment rows ordered as PAYMENT_COLUMNS; large batches go over COPY"""
+    if not records:
+        return
+    if len(records) >= PAYMENT_COPY_THRESHOLD:
+        await conn.copy_records_to_table("payments", records=records, columns=PAYMENT_COLUMNS)
+    else:
+        await conn.executemany("""
+            INSERT INTO payments (
+                user_id, plan_id, razorpay_customer_id, razorpay_subscription_id,
+                status, session_limit, session_used, start_at, next_billing_at
+            )
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        """, records)
+    await publish_payment_change(conn)
 
 # --- Startup and shutdown events ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global db_pool
+    pool = None
+    supervisor_task = None
+    plan_sync_task = None
+    payment_listener_task = None
+    webhook_cleanup_task = None
     try:
-        db_pool = await asyncpg.create_pool(DATABASE_URL)
+        pool = app.state.pool = await init_db_pool()
         logger.info("Database connection pool initialized")
+        supervisor_task = asyncio.create_task(agent_supervisor())
+        payment_listener_task = asyncio.create_task(payment_state_listener())
+        plan_sync_task = asyncio.create_task(razorpay_plan_sync(pool))
+        webhook_cleanup_task = asyncio.create_task(webhook_event_cleanup(pool))
         yield
     finally:
-        if db_pool:
-            await db_pool.close()
+        if supervisor_task:
+            # Its cleanup terminates the agent worker (SIGKILL if it will not drain)
+            supervisor_task.cancel()
+            await asyncio.gather(supervisor_task, return_exceptions=True)
+        if plan_sync_task:
+            plan_sync_task.cancel()
+        if payment_listener_task:
+            payment_listener_task.cancel()
+        if webhook_cleanup_task:
+            webhook_cleanup_task.cancel()
+        if pool:
+            await pool.close()
             logger.info("Database connection pool closed")
-        for room, proc in list(active_agents.items()):
-            logger.info(f"Shutting down agent for room {room}, PID {proc.pid}")
-            proc.terminate()
-        active_agents.clear()
+        await razorpay_client.aclose()
 
 app.router.lifespan_context = lifespan
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools", workers=WEB_CONCURRENCY, log_level="warning")
\ No newline at end of file